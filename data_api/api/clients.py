@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from temba import TembaClient
+from temba.base import TembaAPIError, TembaConnectionError
+from data_api.api.utils import get_redis
+
+__author__ = 'kenneth'
+
+# Refills the bucket for the time elapsed since it was last used, then takes a token if there is one. Returns the
+# number of seconds to wait before asking again, 0 when a token was taken.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'blocked_until')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+local blocked_until = tonumber(bucket[3]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+else
+    tokens = tokens - 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 3600)
+return tostring(wait)
+"""
+
+_token_bucket_script = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_retry_after(exception):
+    """
+    Returns how many seconds Temba asked us to back off for, None if the error was not a throttling one.
+    """
+    if not isinstance(exception, TembaAPIError) or not isinstance(exception.caused_by, requests.HTTPError):
+        return None
+    response = exception.caused_by.response
+    if response is None or response.status_code not in (429, 503):
+        return None
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return settings.TEMBA_THROTTLE_BACKOFF
+    if retry_after.isdigit():
+        return int(retry_after)
+    date = parsedate_tz(retry_after)
+    if date is None:
+        return settings.TEMBA_THROTTLE_BACKOFF
+    return max(0, mktime_tz(date) - time.time())
+
+
+class TokenBucket(object):
+    """
+    A token bucket kept in Redis, so every worker using the same API token draws from the same allowance.
+    """
+    def __init__(self, name, rate, capacity):
+        self.key = 'throttle:%s' % name
+        self.rate = rate
+        self.capacity = capacity
+
+    def acquire(self):
+        global _token_bucket_script
+        if _token_bucket_script is None:
+            _token_bucket_script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        while True:
+            wait = float(_token_bucket_script(keys=[self.key], args=[self.rate, self.capacity, time.time()]))
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def block(self, seconds):
+        blocked_until = time.time() + seconds
+        pipe = get_redis().pipeline()
+        pipe.hset(self.key, 'blocked_until', blocked_until)
+        pipe.expire(self.key, int(seconds) + 3600)
+        pipe.execute()
+
+
+class ThrottledTembaClient(TembaClient):
+    """
+    A TembaClient that takes a token from the shared bucket of its API token before every request, and stops all
+    workers using that token for as long as Temba asks when it throttles us. Requests go through a keep-alive
+    session so connections are reused for as long as the client is.
+    """
+    def __init__(self, host, token, user_agent=None):
+        super(ThrottledTembaClient, self).__init__(host, token, user_agent=user_agent)
+        self.bucket = TokenBucket(hashlib.sha1(token).hexdigest(), settings.TEMBA_RATE_LIMIT,
+                                  settings.TEMBA_RATE_BURST)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.TEMBA_CLIENT_CONNECTIONS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, url, body=None, params=None):
+        logger.debug("%s %s %s" % (method.upper(), url, json.dumps(params if params else body)))
+        self.bucket.acquire()
+        try:
+            kwargs = {'headers': self.headers}
+            if body:
+                kwargs['data'] = json.dumps(body)
+            if params:
+                kwargs['params'] = params
+
+            response = self.session.request(method, url, **kwargs)
+            response.raise_for_status()
+
+            return response.json() if response.content else None
+        except requests.HTTPError as ex:
+            e = TembaAPIError(ex)
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                self.bucket.block(retry_after)
+            raise e
+        except requests.exceptions.ConnectionError:
+            raise TembaConnectionError()
+
+    def close(self):
+        self.session.close()
+
+
+class TembaClientPool(object):
+    """
+    Keeps one client per (host, api token) for the life of the process so their connections are reused. Clients
+    unused for max_idle seconds, or the least recently used ones beyond max_size, are closed. A forked child (e.g.
+    a Celery prefork worker) starts with an empty pool rather than sharing its parent's sockets.
+    """
+    def __init__(self, max_size, max_idle):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, host, token, user_agent=None):
+        key = (host, token, user_agent)
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = OrderedDict()
+                self._pid = os.getpid()
+            while self._clients and now - self._clients.itervalues().next()[1] > self.max_idle:
+                self._clients.popitem(last=False)[1][0].close()
+            client, last_used = self._clients.pop(key, (None, None))
+            if client is None:
+                client = ThrottledTembaClient(host, token, user_agent=user_agent)
+            self._clients[key] = (client, now)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)[1][0].close()
+        return client
+
+    def clear(self):
+        with self._lock:
+            for client, last_used in self._clients.values():
+                client.close()
+            self._clients = OrderedDict()
+
+
+client_pool = TembaClientPool(settings.TEMBA_CLIENT_POOL_SIZE, settings.TEMBA_CLIENT_IDLE_TIMEOUT)
@@ -0,0 +1,185 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import random
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urllib
+from urlparse import urlparse, parse_qs
+from temba.utils import format_iso8601, parse_iso8601
+import pytz
+
+__author__ = 'kenneth'
+
+
+EPOCH = datetime(2015, 1, 1, tzinfo=pytz.utc)
+
+
+def _date(i):
+    return format_iso8601(EPOCH + timedelta(minutes=i))
+
+
+def _uuid(prefix, i):
+    return '%s-%08d-0000-0000-0000-000000000000' % (prefix, i)
+
+
+class FakeData(object):
+    """
+    Deterministic synthetic RapidPro objects in the v1 API format. Record i of every endpoint is created i minutes
+    after EPOCH, and references point at records of the other endpoints so that a sync has something to resolve.
+    """
+    def __init__(self, size):
+        self.counts = dict(groups=max(1, size // 100), labels=max(1, size // 100), flows=max(1, size // 100),
+                           campaigns=max(1, size // 500), events=max(1, size // 100), contacts=size,
+                           broadcasts=max(1, size // 10), messages=size, runs=size, results=0, boundaries=0)
+
+    def ref(self, endpoint, prefix, i):
+        return _uuid(prefix, i % self.counts[endpoint])
+
+    def groups(self, i):
+        return dict(uuid=_uuid('grp', i), name='Group %d' % i, size=self.counts['contacts'] // self.counts['groups'])
+
+    def labels(self, i):
+        return dict(uuid=_uuid('lbl', i), name='Label %d' % i, count=i)
+
+    def flows(self, i):
+        rulesets = [dict(node=_uuid('nod', i * 10 + n), label='Question %d' % n, response_type='C') for n in range(3)]
+        return dict(uuid=_uuid('flw', i), name='Flow %d' % i, archived=False, labels=[], participants=i, runs=i,
+                    completed_runs=i, expires=720, rulesets=rulesets, created_on=_date(i))
+
+    def campaigns(self, i):
+        return dict(uuid=_uuid('cmp', i), name='Campaign %d' % i, group_uuid=self.ref('groups', 'grp', i),
+                    created_on=_date(i))
+
+    def events(self, i):
+        return dict(uuid=_uuid('evt', i), campaign_uuid=self.ref('campaigns', 'cmp', i), relative_to='joined_on',
+                    offset=i % 30, unit='D', delivery_hour=9, message=None, flow_uuid=self.ref('flows', 'flw', i),
+                    created_on=_date(i))
+
+    def contacts(self, i):
+        return dict(uuid=_uuid('cnt', i), name='Contact %d' % i, urns=['tel:+256700%06d' % i],
+                    group_uuids=[self.ref('groups', 'grp', i)], fields={'district': 'District %d' % (i % 50)},
+                    language='eng', modified_on=_date(i))
+
+    def broadcasts(self, i):
+        return dict(id=i + 1, urns=[], contacts=[self.ref('contacts', 'cnt', i)], groups=[], text='Broadcast %d' % i,
+                    status='S', created_on=_date(i))
+
+    def messages(self, i):
+        return dict(id=i + 1, broadcast=None, contact=self.ref('contacts', 'cnt', i), urn='tel:+256700%06d' % i,
+                    status='H', type='F', labels=[], direction='I', archived=False, text='Reply %d' % i,
+                    created_on=_date(i), delivered_on=None, sent_on=None)
+
+    def runs(self, i):
+        flow = i % self.counts['flows']
+        nodes = [_uuid('nod', flow * 10 + n) for n in range(3)]
+        steps = [dict(node=node, text='Question %d' % n, value=None, type='A', arrived_on=_date(i), left_on=_date(i))
+                 for n, node in enumerate(nodes)]
+        values = [dict(node=node, category={'base': 'Yes'}, text='yes', rule_value='yes', value='Yes',
+                       label='Question %d' % n, time=_date(i)) for n, node in enumerate(nodes)]
+        return dict(run=i + 1, flow_uuid=_uuid('flw', flow), contact=self.ref('contacts', 'cnt', i), steps=steps,
+                    values=values, created_on=_date(i), expires_on=None, expired_on=None, completed=True)
+
+    def page(self, endpoint, params, page, page_size):
+        """
+        Returns the total number of matching records and the given page of them, or None for unknown endpoints.
+        """
+        if endpoint not in self.counts:
+            return None
+        count = self.counts[endpoint]
+        build = getattr(self, endpoint, None)
+        for key, offset in (('uuid', 0), ('id', 1), ('run', 1)):
+            if key in params:
+                indexes = [int(value.split('-')[1]) if '-' in value else int(value) - offset
+                           for value in params[key] if value]
+                records = [build(i) for i in indexes if 0 <= i < count]
+                return len(records), records
+        start = 0
+        if params.get('after'):
+            minutes = (parse_iso8601(params['after'][0]) - EPOCH).total_seconds() // 60
+            start = min(count, max(0, int(minutes) + 1))
+        first = start + (page - 1) * page_size
+        return count - start, [build(i) for i in xrange(first, min(count, first + page_size))]
+
+
+class FakeRapidProHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip('/').split('/')[-1].replace('.json', '')
+        params = dict((key.rstrip('[]'), value) for key, value in parse_qs(url.query).items())
+        server.record_request(endpoint)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self.respond(server.error_status, {'detail': 'Injected error'},
+                                {'Retry-After': '1'} if server.error_status == 429 else None)
+
+        page = int(params.get('page', ['1'])[0])
+        result = server.data.page(endpoint, params, page, server.page_size)
+        if result is None:
+            return self.respond(404, {'detail': 'Not found'})
+        count, results = result
+        next_url = None
+        if page * server.page_size < count:
+            query = dict((key, value[0]) for key, value in params.items())
+            query['page'] = page + 1
+            next_url = '%s/%s.json?%s' % (server.url, endpoint, urllib.urlencode(query))
+        self.respond(200, dict(count=count, next=next_url, previous=None, results=results))
+
+    def respond(self, status, body, headers=None):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeRapidPro(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in for the RapidPro v1 API, serving FakeData pages of page_size records. Every request waits latency
+    seconds, and a share error_rate of them fail with error_status.
+    """
+    daemon_threads = True
+
+    def __init__(self, size=1000, page_size=250, latency=0, error_rate=0, error_status=500, port=0, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeRapidProHandler)
+        self.data = FakeData(size)
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = defaultdict(int)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/api/v1' % self.server_address
+
+    def record_request(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
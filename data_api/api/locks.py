@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+from uuid import uuid4
+from data_api.api.utils import get_redis
+
+__author__ = 'kenneth'
+
+# Deletes or extends the lease only while it is still held with our token, so a worker whose lease expired and was
+# taken over cannot release or prolong someone else's
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Likewise refreshes a semaphore slot only while it is still there, a slot that was reclaimed is not taken back
+REFRESH_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    return redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return 0
+"""
+
+_scripts = {}
+
+logger = logging.getLogger(__name__)
+
+
+def _script(source):
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+
+class Semaphore(object):
+    """
+    A counting semaphore shared by all workers through a Redis sorted set. Slots that are neither released nor
+    refreshed for timeout seconds, e.g. by a worker that died, are reclaimed.
+    """
+    def __init__(self, name, limit, timeout):
+        self.key = 'semaphore:%s' % name
+        self.limit = limit
+        self.timeout = timeout
+
+    def acquire(self):
+        token = uuid4().hex
+        now = time.time()
+        pipe = get_redis().pipeline()
+        pipe.zremrangebyscore(self.key, '-inf', now - self.timeout)
+        pipe.zadd(self.key, now, token)
+        pipe.zrank(self.key, token)
+        pipe.expire(self.key, int(self.timeout))
+        rank = pipe.execute()[2]
+        if rank < self.limit:
+            return token
+        self.release(token)
+        return None
+
+    def refresh(self, token):
+        return bool(_script(REFRESH_SCRIPT)(keys=[self.key], args=[token, time.time(), int(self.timeout)]))
+
+    def release(self, token):
+        get_redis().zrem(self.key, token)
+
+
+class Lease(object):
+    """
+    An exclusive claim on a resource shared by all workers through a Redis key set with NX. The claim lapses after
+    ttl seconds unless it is extended, so a worker that dies cannot hold it forever.
+    """
+    def __init__(self, name, ttl):
+        self.key = 'lease:%s' % name
+        self.ttl = ttl
+        self.token = None
+
+    def acquire(self, wait=0):
+        token = uuid4().hex
+        deadline = time.time() + wait
+        while True:
+            if get_redis().set(self.key, token, nx=True, px=int(self.ttl * 1000)):
+                self.token = token
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(1, deadline - time.time()))
+
+    def extend(self):
+        return bool(self.token and _script(EXTEND_SCRIPT)(keys=[self.key], args=[self.token, int(self.ttl * 1000)]))
+
+    def release(self):
+        if self.token:
+            _script(RELEASE_SCRIPT)(keys=[self.key], args=[self.token])
+            self.token = None
+
+    @contextmanager
+    def kept_alive(self, *slots):
+        """
+        Extends the lease every third of its ttl from a background thread until the block exits, then releases it.
+        slots are (semaphore, token) pairs refreshed along with it, so that they are not reclaimed however long the
+        block runs.
+        """
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self.ttl / 3.0):
+                for semaphore, token in slots:
+                    if not semaphore.refresh(token):
+                        logger.warning("Lost slot %s", semaphore.key)
+                if not self.extend():
+                    logger.warning("Lost lease %s", self.key)
+                    return
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            done.set()
+            self.release()
@@ -0,0 +1,117 @@
+import time
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from mongoengine import EmbeddedDocumentField, ListField, ReferenceField
+from temba import types
+from data_api.api.fake_rapidpro import FakeData
+from data_api.api.models import BaseUtil, Org, Run, Message, Contact, Flow, reference_cache
+
+__author__ = 'kenneth'
+
+
+ENTITIES = {
+    'runs': (Run, types.Run),
+    'messages': (Message, types.Message),
+    'contacts': (Contact, types.Contact),
+    'flows': (Flow, types.Flow),
+}
+
+
+def build_reflective(model, org, temba):
+    """
+    The conversion build_from_temba replaced, which looks every attribute of the Temba object up on the model.
+    """
+    obj = model()
+    for key, value in temba.__dict__.items():
+        class_attr = getattr(model, key, None)
+        if class_attr is None:
+            continue
+        if key in model.references:
+            item_class = BaseUtil.get_entity(model.references[key])
+            if isinstance(class_attr, ListField):
+                setattr(obj, key, [item.as_reference() for item in
+                                   item_class.get_objects_from_uuids(org, value or []) if item])
+            else:
+                setattr(obj, key, item_class.get_reference(org, value))
+        elif isinstance(class_attr, ListField):
+            item_class = class_attr.field
+            if isinstance(item_class, EmbeddedDocumentField):
+                item_class = item_class.document_type_obj
+                setattr(obj, key, item_class.create_from_temba_list(getattr(temba, key)))
+            elif isinstance(item_class, ReferenceField):
+                item_class = item_class.document_type_obj
+                setattr(obj, key, item_class.get_objects_from_uuids(org, getattr(temba, key)))
+            else:
+                setattr(obj, key, value)
+        elif isinstance(class_attr, ReferenceField):
+            item_class = class_attr.document_type_obj
+            setattr(obj, key, item_class.get_or_fetch(org, getattr(temba, key)))
+        elif isinstance(class_attr, EmbeddedDocumentField):
+            item_class = class_attr.document_type_obj
+            setattr(obj, key, item_class.create_from_temba(getattr(temba, key)))
+        else:
+            if key == 'id':
+                key = 'tid'
+            setattr(obj, key, value)
+
+    obj.org = org.as_reference()
+    return obj
+
+
+def get_fake_references(model, temba_list):
+    """
+    A stand-in, not stored, for every record the objects reference, keyed by entity and uuid (or id).
+    """
+    references = {}
+    for key, entity in model.references.items():
+        referenced = BaseUtil.get_entity(entity)
+        for temba in temba_list:
+            value = getattr(temba, key, None)
+            for uuid in value if isinstance(value, list) else [value]:
+                if uuid is not None and (referenced, uuid) not in references:
+                    references[(referenced, uuid)] = referenced(id=ObjectId(), **{referenced.get_reference_key(): uuid})
+    return references
+
+
+class Command(BaseCommand):
+    help = "Measures how many Temba objects per second build_from_temba converts to documents, against the " \
+           "reflective conversion it replaced. References resolve to stand-ins kept in the reference cache, so " \
+           "nothing is read from or written to Mongo, and RapidPro is not called."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=20000)
+        parser.add_argument('--repeat', type=int, default=3, help="Best of this many passes is reported")
+        parser.add_argument('entities', nargs='*', help="Any of %s, runs and messages by default" %
+                                                        ", ".join(sorted(ENTITIES.keys())))
+
+    def handle(self, *args, **options):
+        org = Org(id=ObjectId(), name='Benchmark', api_token='benchmark')
+        data = FakeData(options['records'])
+        for name in options['entities'] or ['runs', 'messages']:
+            if name not in ENTITIES:
+                raise CommandError("Unknown entity %s" % name)
+            model, temba_type = ENTITIES[name]
+            temba_list = [temba_type.deserialize(getattr(data, name)(i)) for i in xrange(options['records'])]
+            references = get_fake_references(model, temba_list)
+            with reference_cache(max_size=len(references) + 1):
+                for (referenced, uuid), obj in references.items():
+                    referenced.set_cached(org, uuid, obj)
+                planned = model.build_from_temba(org, temba_list[0]).to_mongo()
+                if planned != build_reflective(model, org, temba_list[0]).to_mongo():
+                    raise CommandError("Conversion plan of %s does not match the reflective conversion" %
+                                       model.__name__)
+                reflective = self.measure(lambda org, temba: build_reflective(model, org, temba), org, temba_list,
+                                          options['repeat'])
+                compiled = self.measure(model.build_from_temba, org, temba_list, options['repeat'])
+            self.stdout.write("%-10s reflective: %8.0f records/s   plan: %8.0f records/s   (x%.2f)" % (
+                model.__name__, reflective, compiled, compiled / reflective))
+
+    def measure(self, build, org, temba_list, repeat):
+        best = None
+        for i in range(repeat):
+            started = time.time()
+            for temba in temba_list:
+                build(org, temba)
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return len(temba_list) / best
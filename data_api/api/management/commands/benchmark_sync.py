@@ -0,0 +1,88 @@
+import time
+import uuid
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from data_api.api.clients import client_pool
+from data_api.api.fake_rapidpro import FakeRapidPro
+from data_api.api.models import BaseUtil, Org, LastSaved, SyncStep
+from data_api.api.tasks import plan_sync, sync_entity
+
+__author__ = 'kenneth'
+
+
+OPCOUNTERS = ('insert', 'query', 'update', 'delete', 'getmore', 'command')
+
+
+class Command(BaseCommand):
+    help = "Runs a full ingestion against a local fake RapidPro server and reports throughput, API calls and Mongo " \
+           "operations per record. Uses the configured Mongo and Redis; the records it creates are removed after."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=10000, help="Contacts, messages and runs to serve")
+        parser.add_argument('--page-size', type=int, default=250, help="Records per API page")
+        parser.add_argument('--latency', type=float, default=0, help="Seconds added to every API call")
+        parser.add_argument('--error-rate', type=float, default=0, help="Share of API calls that fail")
+        parser.add_argument('--error-status', type=int, default=500, help="HTTP status of the failed calls")
+        parser.add_argument('--entities', nargs='*', help="Entities to sync, all of them by default")
+        parser.add_argument('--bulk', type=int, choices=(0, 1), default=int(settings.SYNC_BULK_UPSERT))
+        parser.add_argument('--prefetch', type=int, default=settings.SYNC_PREFETCH_DEPTH)
+        parser.add_argument('--rate-limit', type=float, default=1000,
+                            help="Requests per second allowed against the fake server")
+        parser.add_argument('--keep', action='store_true', help="Keep the synced records and benchmark org")
+
+    def handle(self, *args, **options):
+        server = FakeRapidPro(size=options['size'], page_size=options['page_size'], latency=options['latency'],
+                              error_rate=options['error_rate'], error_status=options['error_status']).start()
+        overrides = dict(SITE_API_HOST=server.url, TEMBA_RATE_LIMIT=options['rate_limit'],
+                         TEMBA_RATE_BURST=int(options['rate_limit']))
+        saved = dict((key, getattr(settings, key, None)) for key in overrides)
+        for key, value in overrides.items():
+            setattr(settings, key, value)
+        client_pool.clear()
+
+        names = options['entities'] or [cls.__name__ for cls in BaseUtil.__subclasses__()]
+        entities = [dict(name=name, bulk=bool(options['bulk']), prefetch=options['prefetch']) for name in names]
+        org = Org.objects.create(name='Benchmark %s' % uuid.uuid4().hex[:8], api_token=uuid.uuid4().hex,
+                                 is_active=False)
+        db = Org._get_db()
+        try:
+            ops_before = self.get_opcounters(db)
+            started = time.time()
+            results = []
+            for level in plan_sync(entities):
+                for entity in level:
+                    results.append(sync_entity(dict(entity, name=BaseUtil.get_entity(entity['name'])), org))
+            elapsed = time.time() - started
+            ops = self.get_opcounters(db) - ops_before
+            records = sum(BaseUtil.get_entity(name).get_for_org(org.id).count() for name in names)
+            self.report(server, results, records, elapsed, ops, options)
+        finally:
+            for key, value in saved.items():
+                setattr(settings, key, value)
+            client_pool.clear()
+            server.stop()
+            if not options['keep']:
+                for name in names:
+                    BaseUtil.get_entity(name).get_for_org(org.id).delete()
+                LastSaved.objects.filter(org__id=org.id).delete()
+                SyncStep.objects.filter(org__id=org.id).delete()
+                org.delete()
+
+    def get_opcounters(self, db):
+        counters = db.command('serverStatus')['opcounters']
+        return sum(counters.get(key, 0) for key in OPCOUNTERS)
+
+    def report(self, server, results, records, elapsed, ops, options):
+        self.stdout.write("Synced %s records in %.2fs (size %s, page size %s, latency %ss, error rate %s, bulk %s, "
+                          "prefetch %s)" % (records, elapsed, options['size'], options['page_size'],
+                                            options['latency'], options['error_rate'], options['bulk'],
+                                            options['prefetch']))
+        for result in results:
+            self.stdout.write("  %-10s %-9s %s pages" % (result['entity'], result['status'], result['pages']))
+        per_record = float(max(records, 1))
+        self.stdout.write("records/sec:          %.1f" % (records / elapsed if elapsed else 0))
+        self.stdout.write("API calls:            %s (%.4f per record)" % (server.request_count,
+                                                                          server.request_count / per_record))
+        for endpoint, count in sorted(server.requests.items()):
+            self.stdout.write("  %-12s %s" % (endpoint, count))
+        self.stdout.write("Mongo ops:            %s (%.2f per record, server wide)" % (ops, ops / per_record))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from data_api.api.models import BaseUtil
+from data_api.api.tasks import compact_org_references
+
+__author__ = 'kenneth'
+
+
+class Command(BaseCommand):
+    help = "Rewrites the org stored on existing records, a copy or a reference of the whole org document, to the " \
+           "org's id alone, and builds the org.id indexes of the collections that lacked them. Run it before syncing " \
+           "resumes, records synced before it are stored again and their old copy is deleted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('entities', nargs='*', help="Entities to migrate, all of them by default")
+        parser.add_argument('--batch-size', type=int, help="Documents rewritten per bulk update")
+        parser.add_argument('--background', action='store_true', help="Queue the migration as a task instead")
+
+    def handle(self, *args, **options):
+        names = options['entities'] or [cls.__name__ for cls in BaseUtil.__subclasses__()]
+        try:
+            entities = [BaseUtil.get_entity(name) for name in names]
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['background']:
+            compact_org_references.delay(names, options['batch_size'])
+            self.stdout.write("Queued the migration of %s" % ", ".join(names))
+            return
+        for entity in entities:
+            compacted = entity.compact_org_references(options['batch_size'])
+            entity.ensure_indexes()
+            self.stdout.write("%s: %s records compacted" % (entity.__name__, compacted))
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+import time
+from bson import BSON
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from data_api.api.models import Run
+from data_api.api.serializers import RunReadSerializer
+
+__author__ = 'kenneth'
+
+
+class Command(BaseCommand):
+    help = "Stores the steps and values of older runs in their compact form, reporting the storage and the time to " \
+           "read and serialize a page of runs before and after."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.RUN_COMPACT_AFTER_DAYS,
+                            help="Compact runs created more than this many days ago")
+        parser.add_argument('--batch-size', type=int, default=settings.RUN_COMPACT_BATCH)
+        parser.add_argument('--limit', type=int, help="Compact at most this many runs")
+        parser.add_argument('--report', action='store_true',
+                            help="Only compare the two forms on a sample of the runs, nothing is written")
+        parser.add_argument('--sample', type=int, default=1000, help="Runs compared by --report")
+        parser.add_argument('--page-size', type=int, default=100, help="Runs per page timed by --report")
+
+    def handle(self, *args, **options):
+        before = datetime.utcnow() - timedelta(days=options['older_than'])
+        if options['report']:
+            return self.report(before, options['sample'], options['page_size'])
+        collection = Run._get_collection()
+        size_before = Run._get_db().command('collstats', collection.name)['size']
+        started = time.time()
+        compacted = Run.compact(before, batch_size=options['batch_size'], limit=options['limit'])
+        size_after = Run._get_db().command('collstats', collection.name)['size']
+        self.stdout.write("Compacted %s runs created before %s in %.1fs, runs collection %.1f MB -> %.1f MB" % (
+            compacted, before.date(), time.time() - started, size_before / 1048576.0, size_after / 1048576.0))
+
+    def report(self, before, sample, page_size):
+        full = list(Run._get_collection().find({'created_on': {'$lt': before}, 'flow.id': {'$exists': True},
+                                                'steps.0': {'$exists': True}}).limit(sample))
+        if not full:
+            self.stdout.write("No runs to compact created before %s" % before.date())
+            return
+        packed = []
+        for doc in full:
+            doc = dict(doc, packed=Run.pack(doc))
+            doc.pop('steps', None)
+            doc.pop('values', None)
+            packed.append(doc)
+        full_encoded = [BSON.encode(run) for run in full]
+        packed_encoded = [BSON.encode(run) for run in packed]
+        full_size = sum(len(encoded) for encoded in full_encoded) / float(len(full))
+        packed_size = sum(len(encoded) for encoded in packed_encoded) / float(len(full))
+        self.stdout.write("%s runs, average size %.0f bytes -> %.0f bytes (%.0f%%)" % (
+            len(full), full_size, packed_size, 100 * packed_size / full_size))
+        full_time = self.time_pages(full_encoded, page_size)
+        packed_time = self.time_pages(packed_encoded, page_size)
+        self.stdout.write("Decoding and serializing a page of %s runs: %.1f ms -> %.1f ms" % (
+            page_size, full_time * 1000, packed_time * 1000))
+
+    def time_pages(self, encoded, page_size):
+        started = time.time()
+        for i in range(0, len(encoded), page_size):
+            runs = [Run._from_son(BSON(doc).decode()) for doc in encoded[i:i + page_size]]
+            RunReadSerializer(runs, many=True).data
+        return (time.time() - started) / max(1, (len(encoded) + page_size - 1) // page_size)
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from pymongo.errors import OperationFailure
+from data_api.api.models import BaseUtil, Org, LastSaved, SyncRun, SyncStep, FailedPage, FlowNodes
+
+__author__ = 'kenneth'
+
+
+def _key(fields):
+    return tuple((field, int(direction) if isinstance(direction, float) else direction) for field, direction in fields)
+
+
+class Command(BaseCommand):
+    help = "Builds, in the background, the indexes declared in the models that are missing from their collections, " \
+           "and reports indexes that are not declared, have not been used since the server started, or are " \
+           "redundant because another index starts with the same fields."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', action='store_true', help="Only report, build nothing")
+
+    def handle(self, *args, **options):
+        models = [Org, LastSaved, SyncRun, SyncStep, FailedPage, FlowNodes] + BaseUtil.__subclasses__()
+        for model in models:
+            # the raw collection, _get_collection() would build the missing indexes on its first call
+            collection = model._get_db()[model._get_collection_name()]
+            declared = set(_key(spec['fields']) for spec in model._meta['index_specs'])
+            existing = dict((_key(info['key']), (name, info)) for name, info in collection.index_information().items()
+                            if name != '_id_')
+            missing = [key for key in declared if key not in existing]
+            if missing and not options['report']:
+                model.ensure_indexes()
+            self.stdout.write("%s (%s)" % (model.__name__, collection.name))
+            self.write_keys("missing" if options['report'] else "built", [self.describe(key) for key in missing])
+            self.write_keys("not declared", [name for key, (name, info) in existing.items() if key not in declared])
+            self.write_keys("unused", self.get_unused(collection))
+            self.write_keys("redundant", self.get_redundant(existing))
+
+    def describe(self, key):
+        return ", ".join("%s %s" % (field, direction) for field, direction in key)
+
+    def write_keys(self, label, names):
+        if names:
+            self.stdout.write("  %-13s %s" % (label + ":", "; ".join(sorted(names))))
+
+    def get_redundant(self, existing):
+        redundant = []
+        for key, (name, info) in existing.items():
+            if info.get('unique'):
+                continue
+            longer = [other for other_key, (other, other_info) in existing.items()
+                      if len(other_key) > len(key) and other_key[:len(key)] == key]
+            if longer:
+                redundant.append("%s (prefix of %s)" % (name, longer[0]))
+        return redundant
+
+    def get_unused(self, collection):
+        try:
+            stats = list(collection.aggregate([{'$indexStats': {}}], cursor={}))
+        except OperationFailure:
+            return ["unknown, the server does not support $indexStats"]
+        return [stat['name'] for stat in stats if stat['name'] != '_id_' and not stat['accesses']['ops']]
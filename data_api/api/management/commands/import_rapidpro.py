@@ -0,0 +1,156 @@
+import csv
+import json
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import BulkWriteError
+from temba import types
+from temba.base import IntegerField, TembaException
+from data_api.api.models import Org, Contact, Flow, Run, Message, reference_cache
+
+__author__ = 'kenneth'
+
+
+ENTITIES = {
+    'contacts': (Contact, types.Contact),
+    'flows': (Flow, types.Flow),
+    'runs': (Run, types.Run),
+    'messages': (Message, types.Message),
+}
+
+
+class Command(BaseCommand):
+    help = "Imports contacts, flows, runs or messages for an org from a RapidPro NDJSON or CSV export, bypassing " \
+           "the paged API. References are only resolved against records already stored, RapidPro is not called, so " \
+           "import contacts and flows before the runs and messages that reference them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('entity', choices=sorted(ENTITIES.keys()))
+        parser.add_argument('path', help="Export file, one API object per line (.json, .ndjson) or per row (.csv)")
+        parser.add_argument('--org', required=True, help="ID or API token of the org the records belong to")
+        parser.add_argument('--format', choices=('ndjson', 'csv'),
+                            help="Format of the export, guessed from the file extension by default")
+        parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE,
+                            help="Records written per unordered bulk insert")
+        parser.add_argument('--write-concern', default='1',
+                            help="Write concern w for the inserts, e.g. 0, 1 or majority")
+        parser.add_argument('--journal', action='store_true', help="Wait for inserts to reach the journal")
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help="Drop the collection's secondary indexes during the import and rebuild them after, "
+                                 "the unique indexes are kept")
+        parser.add_argument('--upsert', action='store_true',
+                            help="Upsert on uuid/id instead of inserting, for files overlapping existing records")
+
+    def handle(self, *args, **options):
+        model, temba_type = ENTITIES[options['entity']]
+        org = self.get_org(options['org'])
+        if not os.path.exists(options['path']):
+            raise CommandError("No such file: %s" % options['path'])
+        fmt = options['format'] or ('csv' if options['path'].lower().endswith('.csv') else 'ndjson')
+        w = options['write_concern']
+        write_concern = {'w': int(w) if w.isdigit() else w}
+        if options['journal']:
+            write_concern['j'] = True
+
+        collection = model._get_collection()
+        indexes = self.drop_indexes(collection) if options['defer_indexes'] else None
+        started = time.time()
+        stats = dict(read=0, written=0, failed=0)
+        try:
+            with open(options['path'], 'rb') as f, reference_cache(fetch=False):
+                rows = self.read_csv(f, temba_type) if fmt == 'csv' else self.read_ndjson(f)
+                batch = []
+                for row in rows:
+                    stats['read'] += 1
+                    try:
+                        batch.append(temba_type.deserialize(row))
+                    except TembaException as e:
+                        stats['failed'] += 1
+                        self.stderr.write("Skipping record %s: %s" % (stats['read'], str(e)))
+                        continue
+                    if len(batch) >= options['batch_size']:
+                        self.write_batch(model, org, batch, write_concern, options['upsert'], stats)
+                        batch = []
+                if batch:
+                    self.write_batch(model, org, batch, write_concern, options['upsert'], stats)
+        finally:
+            if indexes is not None:
+                self.restore_indexes(model, collection, indexes)
+
+        elapsed = time.time() - started
+        self.stdout.write("Imported %s of %s %s for %s in %.1fs (%.0f records/s), %s failed" % (
+            stats['written'], stats['read'], options['entity'], org.name, elapsed,
+            stats['written'] / elapsed if elapsed else 0, stats['failed']))
+
+    def get_org(self, value):
+        org = Org.objects.filter(api_token=value).first()
+        if org is None and len(value) == 24:
+            org = Org.objects.filter(id=value).first()
+        if org is None:
+            raise CommandError("No org with ID or API token %s" % value)
+        return org
+
+    def read_ndjson(self, f):
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    def read_csv(self, f, temba_type):
+        int_columns = set(field.src or name for name, field in temba_type._get_fields().items()
+                          if isinstance(field, IntegerField))
+        for row in csv.DictReader(f):
+            # cells missing from short rows are None, those past the header of long rows are kept under None
+            yield dict((key, self.parse_cell(value, key in int_columns)) for key, value in row.items()
+                       if key is not None)
+
+    def parse_cell(self, value, integer=False):
+        if not value:
+            return None
+        value = value.decode('utf-8')
+        if integer and value.lstrip('-').isdigit():
+            return int(value)
+        if value[0] in '[{':
+            try:
+                return json.loads(value)
+            except ValueError:
+                pass
+        return value
+
+    def write_batch(self, model, org, batch, write_concern, upsert, stats):
+        if upsert:
+            result = model.bulk_upsert_from_temba_list(org, batch, update=True)
+            stats['written'] += result['inserted'] + result['updated']
+            return
+        model.prefetch_references(org, batch)
+        bulk = model._get_collection().initialize_unordered_bulk_op()
+        for temba in batch:
+            doc = model.build_from_temba(org, temba).to_mongo()
+            doc.pop('_id', None)
+            bulk.insert(doc)
+        try:
+            result = bulk.execute(write_concern=write_concern)
+            stats['written'] += result['nInserted'] if write_concern['w'] else len(batch)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            stats['written'] += e.details['nInserted']
+            stats['failed'] += len(errors)
+            self.stderr.write("%s records failed to insert, first error: %s" % (len(errors), errors[0]['errmsg']))
+
+    def drop_indexes(self, collection):
+        # the unique indexes stay, without them an import overlapping stored records would duplicate them
+        indexes = dict((name, info) for name, info in collection.index_information().items()
+                       if name != '_id_' and not info.get('unique'))
+        for name in indexes:
+            collection.drop_index(name)
+        self.stdout.write("Dropped %s non-unique indexes: %s" % (len(indexes), ", ".join(sorted(indexes)) or "none"))
+        return indexes
+
+    def restore_indexes(self, model, collection, indexes):
+        started = time.time()
+        for name, info in indexes.items():
+            options = dict((key, info[key]) for key in ('unique', 'sparse', 'expireAfterSeconds') if key in info)
+            collection.create_index(info['key'], name=name, **options)
+        model.ensure_indexes()
+        self.stdout.write("Rebuilt %s indexes in %.1fs" % (len(indexes), time.time() - started))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from data_api.api.models import BaseUtil
+
+__author__ = 'kenneth'
+
+
+class Command(BaseCommand):
+    help = "Deletes all but the oldest copy of records stored more than once for the same org and uuid/id, so the " \
+           "unique indexes on them can be built."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only count the duplicates")
+
+    def handle(self, *args, **options):
+        for entity in BaseUtil.__subclasses__():
+            key = 'uuid' if 'uuid' in entity._fields else 'tid'
+            if key not in entity._fields:
+                continue
+            # the raw collection, _get_collection() would try to build the unique index first
+            collection = entity._get_db()[entity._get_collection_name()]
+            pipeline = [
+                {'$match': {key: {'$ne': None}}},
+                # records stored before they had an org.id are grouped on their whole org
+                {'$group': {'_id': {'org': {'$ifNull': ['$org.id', '$org']}, 'key': '$%s' % key},
+                            'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gt': 1}}},
+            ]
+            removed = 0
+            for group in collection.aggregate(pipeline, allowDiskUse=True, cursor={}):
+                duplicates = sorted(group['ids'])[1:]
+                removed += len(duplicates)
+                if not options['dry_run']:
+                    collection.remove({'_id': {'$in': duplicates}})
+            self.stdout.write("%s: %s duplicates %s" % (entity.__name__, removed,
+                                                       'found' if options['dry_run'] else 'removed'))
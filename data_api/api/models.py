@@ -1,19 +1,60 @@
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import time
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from mongoengine import connect, Document, StringField, BooleanField, ReferenceField, DateTimeField, IntField, \
-    EmbeddedDocument, ListField, EmbeddedDocumentField, DictField, DynamicDocument
+    EmbeddedDocument, ListField, EmbeddedDocumentField, DictField, DynamicDocument, FloatField, ObjectIdField, \
+    NotUniqueError
+from pymongo.errors import BulkWriteError
 from rest_framework.authtoken.models import Token
-from temba import TembaClient
 from temba.base import TembaNoSuchObjectError, TembaException
+from data_api.api.clients import client_pool
+from data_api.api.utils import LRUCache, as_utc, chunks, drain, percentile
 
 __author__ = 'kenneth'
 
 connect(db="rapidpro")
 
+_MISSING = object()
+_reference_cache = None
+_fetch_references = True
+
+
+def _normalize(value):
+    """
+    Brings a value to the form it is read back from Mongo in, datetimes are naive UTC with millisecond precision
+    """
+    if isinstance(value, datetime):
+        value = as_utc(value).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, dict):
+        return dict((k, _normalize(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+@contextmanager
+def reference_cache(max_size=None, fetch=True):
+    """
+    Shares one bounded cache of resolved references between get_or_fetch and get_objects_from_uuids for the
+    duration of a sync, so an object referenced by many records is looked up once. With fetch False, references to
+    records that are not stored resolve to nothing instead of being fetched from RapidPro.
+    """
+    global _reference_cache, _fetch_references
+    previous = _reference_cache, _fetch_references
+    _reference_cache = LRUCache(max_size or settings.REFERENCE_CACHE_SIZE)
+    _fetch_references = fetch
+    try:
+        yield _reference_cache
+    finally:
+        _reference_cache, _fetch_references = previous
+
 
 class Org(Document):
     name = StringField(required=True)
@@ -21,6 +62,9 @@ class Org(Document):
     timezone = StringField(default="UTC")
     api_token = StringField(required=True)
     is_active = BooleanField(default=False)
+    sync_concurrency = IntField()
+    sync_cadences = DictField()
+    webhook_secret = StringField()
     meta = {'collection': 'orgs'}
 
     @classmethod
@@ -37,7 +81,21 @@ class Org(Document):
         if not host:
             host = '%s/api/v1' % settings.API_ENDPOINT  # UReport sites use this
 
-        return TembaClient(host, self.api_token, user_agent=agent)
+        return client_pool.get(host, self.api_token, user_agent=agent)
+
+    def as_reference(self):
+        """
+        What records store in their org field: the org's id and nothing else.
+        """
+        return {'id': self.id}
+
+    def get_cadence(self, entity):
+        """
+        Minutes between incremental syncs of the entity for this org, 0 if it is not synced on a schedule.
+        """
+        if entity in self.sync_cadences:
+            return self.sync_cadences[entity] or 0
+        return settings.SYNC_CADENCES.get(entity, settings.SYNC_DEFAULT_CADENCE)
 
     def __unicode__(self):
         return self.name
@@ -53,60 +111,404 @@ class Org(Document):
 
 
 class LastSaved(DynamicDocument):
+    """
+    Sync cursor of a collection for an org. last_saved is the high-water mark of the last completed pass and is
+    used as the 'after' filter, page, max_modified_on and pages_set_aside track the pass in progress so it can be
+    resumed. dispatched_on is when the scheduler last queued a sync of the collection.
+    """
     coll = StringField()
     org = DictField()
     last_saved = DateTimeField()
+    page = IntField()
+    max_modified_on = DateTimeField()
+    pages_set_aside = IntField(default=0)
+    dispatched_on = DateTimeField()
+
+    @classmethod
+    def get_for(cls, org, coll):
+        ls = cls.objects.filter(**{'coll': coll, 'org.id': org.id}).first()
+        if not ls:
+            ls = cls(coll=coll, org=dict(id=org.id, name=org.name))
+        return ls
+
+    def is_due(self, cadence, now):
+        if not cadence:
+            return False
+        return not self.dispatched_on or self.dispatched_on <= now - timedelta(minutes=cadence)
+
+    @classmethod
+    def mark_dispatched(cls, org, coll, now):
+        # an update rather than a save, so a sync checkpointing the same cursor does not lose its page
+        cls._get_collection().update({'coll': coll, 'org.id': org.id},
+                                     {'$set': {'dispatched_on': now, 'org.name': org.name}}, upsert=True)
+
+    def track(self, temba_list):
+        for temba in temba_list:
+            modified_on = as_utc(getattr(temba, 'modified_on', None) or getattr(temba, 'created_on', None))
+            if modified_on and (not self.max_modified_on or modified_on > as_utc(self.max_modified_on)):
+                self.max_modified_on = modified_on
+
+    def checkpoint(self, page, temba_list=()):
+        self.track(temba_list)
+        self.page = page + 1
+        self.save()
+
+    def set_aside(self, page):
+        self.pages_set_aside = (self.pages_set_aside or 0) + 1
+        self.checkpoint(page)
+
+    def complete(self):
+        # Temba pages shift as records come in, so a page set aside cannot be fetched again by its number. last_saved
+        # stays where it is instead, and the next pass fetches its records again
+        if self.max_modified_on and not self.pages_set_aside:
+            self.last_saved = self.max_modified_on
+        self.page = None
+        self.max_modified_on = None
+        self.pages_set_aside = 0
+        self.save()
+
+
+class SyncRun(Document):
+    started_on = DateTimeField()
+    finished_on = DateTimeField()
+    status = StringField(default='running')
+    entities = ListField(StringField())
+    step_count = IntField(default=0)
+    failed_count = IntField(default=0)
+    pages = IntField(default=0)
+    pending_orgs = IntField(default=0)
+
+    meta = {'collection': 'sync_runs', 'ordering': ['-started_on']}
+
+    def get_steps(self):
+        return SyncStep.objects.filter(run=self.id)
+
+    @classmethod
+    def org_done(cls, run_id):
+        run = cls._get_collection().find_and_modify({'_id': ObjectId(run_id)}, {'$inc': {'pending_orgs': -1}},
+                                                    new=True)
+        return run is not None and run['pending_orgs'] <= 0
+
+    def finish(self):
+        steps = list(self.get_steps())
+        self.step_count = len(steps)
+        self.failed_count = len([step for step in steps if step.status == 'failed'])
+        self.pages = sum(step.pages for step in steps)
+        self.status = 'failed' if self.failed_count else 'completed'
+        self.finished_on = datetime.utcnow()
+        self.save()
+
+
+class SyncStep(Document):
+    """
+    What a sync run did for one org and entity: pages and records written, Temba latency percentiles (ms), time
+    spent writing to Mongo (s) and errors, including failed attempts that were retried.
+    """
+    run = ObjectIdField()
+    org = DictField()
+    entity = StringField()
+    status = StringField(default='running')
+    started_on = DateTimeField()
+    finished_on = DateTimeField()
+    pages = IntField(default=0)
+    inserted = IntField(default=0)
+    updated = IntField(default=0)
+    skipped = IntField(default=0)
+    errors = IntField(default=0)
+    failed_pages = IntField(default=0)
+    temba_latency = DictField()
+    mongo_write_time = FloatField(default=0)
+
+    meta = {'collection': 'sync_steps', 'ordering': ['-started_on']}
+
+    def __init__(self, *args, **kwargs):
+        super(SyncStep, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self.consecutive_failures = 0
+
+    def record_fetch(self, seconds):
+        self.latencies.append(seconds * 1000)
+
+    def record_page(self, stats):
+        self.consecutive_failures = 0
+        self.pages += 1
+        self.inserted += stats['inserted']
+        self.updated += stats['updated']
+        self.skipped += stats['unchanged']
+        self.mongo_write_time += stats['write_time']
+
+    def record_failed_page(self):
+        self.consecutive_failures += 1
+        self.failed_pages += 1
+
+    def finish(self, status):
+        self.status = status
+        self.finished_on = datetime.utcnow()
+        if self.latencies:
+            self.temba_latency = dict(('p%s' % p, percentile(self.latencies, p)) for p in (50, 90, 99))
+        self.save()
+
+
+class FailedPage(Document):
+    """
+    A page a sync could not fetch or write, kept so that it alone can be retried later. after is the cursor the page
+    was requested with. Records that came in since shift the page, so the retry may not get the same records, the
+    cursor is held back until the next pass has fetched them again.
+    """
+    org = DictField()
+    entity = StringField()
+    page = IntField()
+    after = DateTimeField()
+    error = StringField()
+    attempts = IntField(default=0)
+    status = StringField(default='pending')
+    created_on = DateTimeField()
+    next_attempt_on = DateTimeField()
+
+    meta = {'collection': 'failed_pages', 'indexes': [('status', 'next_attempt_on')]}
+
+    @classmethod
+    def record(cls, org, entity, page, after, error):
+        failed = cls.objects.filter(org__id=org.id, entity=entity, page=page, after=after).first()
+        if not failed:
+            failed = cls(org=dict(id=org.id, name=org.name), entity=entity, page=page, after=after,
+                         created_on=datetime.utcnow())
+        failed.status = 'pending'
+        failed.error = error
+        failed.next_attempt_on = datetime.utcnow() + timedelta(seconds=settings.FAILED_PAGE_RETRY_WAIT)
+        failed.save()
+        return failed
+
+    @classmethod
+    def get_due(cls):
+        return cls.objects.filter(status='pending', next_attempt_on__lte=datetime.utcnow()).order_by('next_attempt_on')
+
+    def retry_later(self, error):
+        self.attempts += 1
+        self.error = error
+        if self.attempts >= settings.FAILED_PAGE_MAX_ATTEMPTS:
+            self.status = 'abandoned'
+        wait = min(settings.FAILED_PAGE_RETRY_WAIT * 2 ** self.attempts, settings.FAILED_PAGE_RETRY_MAX)
+        self.next_attempt_on = datetime.utcnow() + timedelta(seconds=wait)
+        self.save()
 
 
 class BaseUtil(object):
+    # fields holding references to other entities, stored as the as_reference() dicts of the records Temba gives the
+    # uuid (or id) of, and the entity referenced
+    references = {}
+    # entities that need syncing first although they are not referenced that way, e.g. labels referenced by name
+    sync_after = ()
+
+    @classmethod
+    def get_entity(cls, name):
+        for subclass in cls.__subclasses__():
+            if subclass.__name__ == name:
+                return subclass
+        raise ValueError("No entity named %s" % name)
+
     @classmethod
     def create_from_temba(cls, org, temba):
-        obj = cls()
-        for key, value in temba.__dict__.items():
-            class_attr = getattr(cls, key, None)
-            if class_attr is None:
-                continue
-            if isinstance(class_attr, ListField):
-                item_class = class_attr.field
+        obj = cls.build_from_temba(org, temba)
+        obj.save()
+        return obj
+
+    @classmethod
+    def compile_conversion_plan(cls):
+        """
+        Works out once per model how each Temba attribute is stored: the attribute it is stored under and the function
+        converting its value, None when the value is stored as is.
+        """
+        plan = {}
+        for key, field in cls._fields.items():
+            convert = None
+            if key in cls.references:
+                item_class = BaseUtil.get_entity(cls.references[key])
+                if isinstance(field, ListField):
+                    convert = lambda org, value, item_class=item_class: \
+                        [obj.as_reference() for obj in item_class.get_objects_from_uuids(org, value or []) if obj]
+                else:
+                    convert = lambda org, value, item_class=item_class: item_class.get_reference(org, value)
+            elif isinstance(field, ListField):
+                item_class = field.field
                 if isinstance(item_class, EmbeddedDocumentField):
-                    item_class = item_class.document_type_obj
-                    setattr(obj, key, item_class.create_from_temba_list(getattr(temba, key)))
+                    convert = lambda org, value, item_class=item_class.document_type_obj: \
+                        item_class.create_from_temba_list(value)
                 elif isinstance(item_class, ReferenceField):
-                    item_class = item_class.document_type_obj
-                    setattr(obj, key, item_class.get_objects_from_uuids(org, getattr(temba, key)))
-                else:
-                    setattr(obj, key, value)
-            elif isinstance(class_attr, ReferenceField):
-                item_class = class_attr.document_type_obj
-                setattr(obj, key, item_class.get_or_fetch(org, getattr(temba, key)))
-            elif isinstance(class_attr, EmbeddedDocumentField):
-                item_class = class_attr.document_type_obj
-                setattr(obj, key, item_class.create_from_temba(getattr(temba, key)))
-            else:
-                if key == 'id':
-                    key = 'tid'
-                setattr(obj, key, value)
+                    convert = lambda org, value, item_class=item_class.document_type_obj: \
+                        item_class.get_objects_from_uuids(org, value)
+            elif isinstance(field, ReferenceField):
+                convert = lambda org, value, item_class=field.document_type_obj: item_class.get_or_fetch(org, value)
+            elif isinstance(field, EmbeddedDocumentField):
+                convert = lambda org, value, item_class=field.document_type_obj: item_class.create_from_temba(value)
+            plan[key] = ('tid' if key == 'id' else key, convert)
+        cls._conversion_plan = plan
+        return plan
 
-        obj.org = org
-        obj.save()
-        return obj
+    @classmethod
+    def build_from_temba(cls, org, temba):
+        plan = cls._conversion_plan
+        values = {'org': org.as_reference()}
+        for key, value in temba.__dict__.iteritems():
+            step = plan.get(key)
+            if step is None:
+                continue
+            name, convert = step
+            values[name] = value if convert is None else convert(org, value)
+        # passing the values to the constructor skips the defaults, casting and change tracking that setting them one
+        # by one on a new document goes through
+        values['__auto_convert'] = False
+        return cls(**values)
+
+    @classmethod
+    def get_lookup(cls, temba):
+        if hasattr(temba, 'uuid'):
+            return {'uuid': temba.uuid}
+        if hasattr(temba, 'id'):
+            return {'tid': temba.id}
+        return None
+
+    @classmethod
+    def get_org_query(cls, org):
+        return {'org.id': org.id}
+
+    @classmethod
+    def compact_org_references(cls, batch_size=None):
+        """
+        Rewrites, batch_size documents at a time, the org of documents that store more than its id (its name, the whole
+        org document or a reference to it) to the org's id alone. Returns the number of documents rewritten.
+
+        Syncs look records up by org.id, so one that runs before this stores a second copy of every record whose org
+        is a reference. The copy it stored is the more recent one, the old document is deleted.
+        """
+        collection = cls._get_collection()
+        legacy = {'$or': [{'org.name': {'$exists': True}}, {'org._ref': {'$exists': True}}]}
+        compacted = 0
+        while True:
+            batch = list(collection.find(legacy, {'org': 1}).limit(batch_size or settings.ORG_MIGRATION_BATCH))
+            if not batch:
+                return compacted
+            bulk = collection.initialize_unordered_bulk_op()
+            for doc in batch:
+                org = doc['org']
+                org_id = org['_ref'].id if '_ref' in org else org.get('id', org.get('_id'))
+                bulk.find({'_id': doc['_id']}).update_one({'$set': {'org': {'id': org_id}}})
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                errors = e.details['writeErrors']
+                if any(error['code'] != 11000 for error in errors):
+                    raise
+                collection.remove({'_id': {'$in': [batch[error['index']]['_id'] for error in errors]}})
+            compacted += len(batch)
+
+    @classmethod
+    def get_reference_key(cls):
+        if cls == Label:
+            return 'name'
+        if hasattr(cls, 'uuid'):
+            return 'uuid'
+        return 'tid'
+
+    @classmethod
+    def get_cached(cls, org, uuid):
+        if _reference_cache is None:
+            return _MISSING
+        return _reference_cache.get((cls.__name__, org.id, uuid), _MISSING)
+
+    @classmethod
+    def set_cached(cls, org, uuid, obj):
+        if _reference_cache is not None:
+            _reference_cache.set((cls.__name__, org.id, uuid), obj)
 
     @classmethod
     def get_or_fetch(cls, org, uuid):
         if uuid == None: return None
-        if hasattr(cls, 'uuid'):
-            obj = cls.objects.filter(uuid=uuid).first()
-            if cls == Label:
-                obj = cls.objects.filter(name=uuid).first()
-        else:
-            obj = cls.objects.filter(tid=uuid).first()
-        if not obj:
-            try:
-                obj = cls.fetch(org, uuid)
-            except (TembaNoSuchObjectError, TembaException):
-                obj = None
+        obj = cls.get_cached(org, uuid)
+        if obj is _MISSING:
+            obj = cls.get_for_org(org.id).filter(**{cls.get_reference_key(): uuid}).first() or \
+                cls.fetch_or_none(org, uuid)
+            cls.set_cached(org, uuid, obj)
         return obj
 
+    @classmethod
+    def get_reference(cls, org, uuid):
+        """
+        What a record referencing the one with this uuid (or id) stores, an empty dict when there is no such record.
+        """
+        obj = cls.get_or_fetch(org, uuid)
+        return obj.as_reference() if obj else {}
+
+    def as_reference(self):
+        return {'id': self.id}
+
+    @classmethod
+    def fetch_or_none(cls, org, uuid):
+        if not _fetch_references:
+            return None
+        try:
+            return cls.fetch(org, uuid)
+        except (TembaNoSuchObjectError, TembaException):
+            return None
+
+    @classmethod
+    def get_reference_fields(cls):
+        references = {}
+        for key, field in cls._fields.items():
+            if isinstance(field, ListField):
+                field = field.field
+            if isinstance(field, ReferenceField):
+                references[key] = field.document_type
+        for key, name in cls.references.items():
+            references[key] = BaseUtil.get_entity(name)
+        return references
+
+    @classmethod
+    def get_dependencies(cls):
+        dependencies = set(item_class.__name__ for item_class in cls.get_reference_fields().values())
+        return dependencies.union(cls.sync_after)
+
+    @classmethod
+    def prefetch_references(cls, org, temba_list):
+        for key, item_class in cls.get_reference_fields().items():
+            uuids = set()
+            for temba in temba_list:
+                value = getattr(temba, key, None)
+                if isinstance(value, (list, tuple)):
+                    uuids.update(value)
+                elif value is not None:
+                    uuids.add(value)
+            item_class.fetch_missing(org, uuids)
+
+    @classmethod
+    def fetch_missing(cls, org, uuids):
+        key = cls.get_reference_key()
+        uuids = [uuid for uuid in uuids if cls.get_cached(org, uuid) is _MISSING]
+        if key == 'name' or not uuids:
+            return
+        local = set()
+        for obj in cls.get_for_org(org.id).filter(**{'%s__in' % key: uuids}):
+            local.add(getattr(obj, key))
+            cls.set_cached(org, getattr(obj, key), obj)
+        missing = [uuid for uuid in uuids if uuid not in local]
+        if not _fetch_references:
+            for uuid in missing:
+                cls.set_cached(org, uuid, None)
+            return
+        fetch_all = getattr(org.get_temba_client(), "get_%s" % cls._meta['collection'])
+        param = 'uuids' if key == 'uuid' else 'ids'
+        size = settings.REFERENCE_FETCH_CHUNK
+        for chunk in chunks(missing, size):
+            try:
+                temba_list = fetch_all(**{param: chunk})
+            except TembaException:
+                continue
+            cls.bulk_upsert_from_temba_list(org, temba_list)
+            stored = cls.get_for_org(org.id).filter(**{'%s__in' % key: chunk})
+            fetched = dict((getattr(obj, key), obj) for obj in stored)
+            for uuid in chunk:
+                cls.set_cached(org, uuid, fetched.get(uuid))
+
     @classmethod
     def fetch(cls, org, uuid):
         func = "get_%s" % cls._meta['collection']
@@ -114,48 +516,185 @@ class BaseUtil(object):
         return cls.create_from_temba(org, fetch(uuid))
 
     @classmethod
-    def create_from_temba_list(cls, org, temba_list):
-        obj_list = []
-        q = None
-        for temba in temba_list:
-            if hasattr(temba, 'uuid'):
-                q = {'uuid': temba.uuid}
-            elif hasattr(temba, 'id'):
-                q = {'tid': temba.id}
-            if not q or not cls.objects.filter(**q).first():
-                obj_list.append(cls.create_from_temba(org, temba))
-        return obj_list
+    def create_from_temba_list(cls, org, temba_list, update=False, stats=None):
+        """
+        Saves the records of temba_list that are not stored yet, one at a time, emptying the list as it goes.
+        """
+        cls.prefetch_references(org, temba_list)
+        stats = stats if stats is not None else dict(inserted=0, updated=0, unchanged=0, write_time=0)
+        org_query = cls.get_org_query(org)
+        for temba in drain(temba_list):
+            q = cls.get_lookup(temba)
+            started = time.time()
+            existing = q and cls._get_collection().find_one(dict(q, **org_query))
+            stats['write_time'] += time.time() - started
+            if not existing:
+                obj = cls.build_from_temba(org, temba)
+                started = time.time()
+                try:
+                    obj.save()
+                    stats['inserted'] += 1
+                except NotUniqueError:
+                    # stored by another worker since we looked
+                    stats['unchanged'] += 1
+                stats['write_time'] += time.time() - started
+            elif update and cls.update_from_temba(org, existing, temba, stats=stats):
+                stats['updated'] += 1
+            else:
+                stats['unchanged'] += 1
+        return stats
+
+    @classmethod
+    def update_from_temba(cls, org, existing, temba, stats=None):
+        doc = cls.build_from_temba(org, temba).to_mongo()
+        doc.pop('_id', None)
+        changes = cls.get_changes(existing, doc)
+        if changes:
+            started = time.time()
+            cls._get_collection().update({'_id': existing['_id']}, changes)
+            if stats is not None:
+                stats['write_time'] += time.time() - started
+        return changes
+
+    @classmethod
+    def get_changes(cls, existing, doc):
+        """
+        Returns the update bringing the stored document to doc, nothing when the stored document has a modified_on at
+        least as recent as the incoming one. Fields Temba cleared are left out of doc by to_mongo(), the declared
+        fields the stored document still has and doc lacks are unset.
+        """
+        incoming, stored = doc.get('modified_on'), existing.get('modified_on')
+        if incoming and stored and _normalize(incoming) <= _normalize(stored):
+            return {}
+        changes = {}
+        updated = dict((key, value) for key, value in doc.items() if _normalize(value) != _normalize(existing.get(key)))
+        if updated:
+            changes['$set'] = updated
+        cleared = dict((field.db_field, '') for field in cls._fields.values()
+                       if field.db_field not in ('_id', 'org') and field.db_field in existing and
+                       field.db_field not in doc)
+        if cleared:
+            changes['$unset'] = cleared
+        return changes
+
+    @classmethod
+    def iter_docs(cls, org, temba_list):
+        for temba in drain(temba_list):
+            doc = cls.build_from_temba(org, temba).to_mongo()
+            doc.pop('_id', None)
+            yield cls.get_lookup(temba), doc
+
+    @classmethod
+    def bulk_upsert_from_temba_list(cls, org, temba_list, update=False, batch_size=None):
+        """
+        Converts the records of temba_list as it empties the list and writes them with one unordered bulk upsert per
+        batch_size records, so that a page is never held in memory as both records and documents.
+        """
+        cls.prefetch_references(org, temba_list)
+        stats = dict(inserted=0, updated=0, unchanged=0, write_time=0)
+        org_query = cls.get_org_query(org)
+        for batch in chunks(cls.iter_docs(org, temba_list), batch_size or settings.SYNC_WRITE_BATCH):
+            cls.bulk_write_docs(org_query, batch, update, stats)
+        return stats
+
+    @classmethod
+    def bulk_write_docs(cls, org_query, batch, update, stats):
+        keyed, unkeyed = OrderedDict(), []
+        for q, doc in batch:
+            if q:
+                keyed[q.items()[0]] = doc
+            else:
+                unkeyed.append(doc)
+        started = time.time()
+        existing = {}
+        for field in set(field for field, value in keyed.keys()):
+            values = [value for f, value in keyed.keys() if f == field]
+            for stored in cls._get_collection().find(dict(org_query, **{field: {'$in': values}})):
+                existing[(field, stored[field])] = stored
+        bulk = cls._get_collection().initialize_unordered_bulk_op()
+        ops = updated = 0
+        for doc in unkeyed:
+            bulk.insert(doc)
+            ops += 1
+        for (field, value), doc in keyed.items():
+            stored = existing.get((field, value))
+            if not stored:
+                # the org comes from the query, setting it again would conflict with it
+                doc.pop('org', None)
+                bulk.find(dict(org_query, **{field: value})).upsert().update_one({'$setOnInsert': doc})
+                ops += 1
+                continue
+            changes = cls.get_changes(stored, doc) if update else {}
+            if changes:
+                bulk.find({'_id': stored['_id']}).update_one(changes)
+                updated += 1
+                ops += 1
+            else:
+                stats['unchanged'] += 1
+        if ops:
+            try:
+                result = bulk.execute()
+            except BulkWriteError as e:
+                # records stored by another worker since we looked break the unique index, they are left as they are
+                result = e.details
+                if any(error['code'] != 11000 for error in result['writeErrors']):
+                    raise
+            inserted = result['nInserted'] + result['nUpserted']
+            stats['inserted'] += inserted
+            stats['updated'] += updated
+            # a record inserted by someone else since we looked only matches its $setOnInsert
+            stats['unchanged'] += ops - updated - inserted
+        stats['write_time'] += time.time() - started
 
     @classmethod
     def get_objects_from_uuids(cls, org, uuids):
+        found = {}
+        for uuid in uuids:
+            obj = cls.get_cached(org, uuid)
+            if obj is not _MISSING:
+                found[uuid] = obj
+        missing = [uuid for uuid in uuids if uuid is not None and uuid not in found]
+        if missing:
+            key = cls.get_reference_key()
+            for obj in cls.get_for_org(org.id).filter(**{'%s__in' % key: missing}):
+                found[getattr(obj, key)] = obj
+                cls.set_cached(org, getattr(obj, key), obj)
         objs = []
         for uuid in uuids:
-            try:
-                objs.append(cls.get_or_fetch(org, uuid))
-            except TembaNoSuchObjectError:
-                continue
+            if uuid not in found and uuid is not None:
+                found[uuid] = cls.fetch_or_none(org, uuid)
+                cls.set_cached(org, uuid, found[uuid])
+            objs.append(found.get(uuid))
         return objs
 
     @classmethod
-    def fetch_objects(cls, org, pager=None):
+    def get_cursor(cls, org):
+        return LastSaved.get_for(org, cls._meta['collection'])
+
+    @classmethod
+    def fetch_page(cls, org, pager=None, after=None):
         func = "get_%s" % cls._meta['collection']
-        ls = LastSaved.objects.filter(**{'coll': cls._meta['collection'], 'org.id': org.id}).first()
-        after = getattr(ls, 'last_saved', None)
         fetch_all = getattr(org.get_temba_client(), func)
         try:
-            objs = cls.create_from_temba_list(org, fetch_all(after=after, pager=pager))
-            if not ls:
-                ls = LastSaved()
-                ls.org = org
-            ls.coll = cls._meta['collection']
-            ls.last_saved = datetime.now(tz=org.timezone)
-            ls.save()
+            return fetch_all(after=as_utc(after), pager=pager)
         except TypeError:
             try:
-                objs = cls.create_from_temba_list(org, fetch_all(pager=pager))
+                return fetch_all(pager=pager)
             except TypeError:
-                objs = cls.create_from_temba_list(org, fetch_all())
-        return objs
+                return fetch_all()
+
+    @classmethod
+    def ingest_page(cls, org, temba_list, bulk=False, update=False):
+        if bulk:
+            return cls.bulk_upsert_from_temba_list(org, temba_list, update=update)
+        stats = dict(inserted=0, updated=0, unchanged=0, write_time=0)
+        cls.create_from_temba_list(org, temba_list, update=update, stats=stats)
+        return stats
+
+    @classmethod
+    def fetch_objects(cls, org, pager=None, bulk=False, update=False):
+        after = cls.get_cursor(org).last_saved
+        return cls.ingest_page(org, cls.fetch_page(org, pager=pager, after=after), bulk=bulk, update=update)
 
     # def __unicode__(self):
     #     if hasattr(self, 'name'):
@@ -173,10 +712,10 @@ class BaseUtil(object):
 class EmbeddedUtil(object):
     @classmethod
     def create_from_temba(cls, temba):
-        obj = cls()
-        for k, v in temba.__dict__.items():
-            setattr(obj, k, v)
-        return obj
+        fields = cls._fields
+        values = dict((k, v) for k, v in temba.__dict__.iteritems() if k in fields)
+        values['__auto_convert'] = False
+        return cls(**values)
 
     @classmethod
     def create_from_temba_list(cls, temba_list):
@@ -194,7 +733,10 @@ class Group(Document, BaseUtil):
     name = StringField()
     size = IntField()
 
-    meta = {'collection': 'groups'}
+    meta = {'collection': 'groups', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'uuid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
 
 
 class Urn(EmbeddedDocument, EmbeddedUtil):
@@ -225,7 +767,11 @@ class Contact(Document, BaseUtil):
     language = StringField()
     fields = DictField()
 
-    meta = {'collection': 'contacts'}
+    meta = {'collection': 'contacts', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'uuid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
+    references = {'groups': 'Group'}
 
 
 class Broadcast(Document, BaseUtil):
@@ -239,7 +785,11 @@ class Broadcast(Document, BaseUtil):
     text = StringField()
     status = StringField()
 
-    meta = {'collection': 'broadcasts'}
+    meta = {'collection': 'broadcasts', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'tid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
+    references = {'contacts': 'Contact', 'groups': 'Group'}
 
     def __unicode__(self):
         return "%s - %s" % (self.text[:7], self.org)
@@ -253,7 +803,11 @@ class Campaign(Document, BaseUtil):
     name = StringField()
     group = DictField()
 
-    meta = {'collection': 'campaigns'}
+    meta = {'collection': 'campaigns', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'uuid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
+    references = {'group': 'Group'}
 
 
 class Ruleset(EmbeddedDocument, EmbeddedUtil):
@@ -273,7 +827,11 @@ class Label(Document, BaseUtil):
     name = StringField()
     count = IntField()
 
-    meta = {'collection': 'labels'}
+    meta = {'collection': 'labels', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'uuid'), 'unique': True},
+        ('org.id', 'name'),
+        ('org.id', 'created_on', 'id'),
+    ]}
 
 
 class Flow(Document, BaseUtil):
@@ -289,7 +847,10 @@ class Flow(Document, BaseUtil):
     completed_runs = IntField()
     rulesets = ListField(EmbeddedDocumentField(Ruleset))
 
-    meta = {'collection': 'flows'}
+    meta = {'collection': 'flows', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'uuid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
 
     def get_runs(self, queryset=None):
         if queryset:
@@ -310,7 +871,11 @@ class Event(Document, BaseUtil):
     message = StringField()
     flow = DictField()
 
-    meta = {'collection': 'events'}
+    meta = {'collection': 'events', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'uuid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
+    references = {'campaign': 'Campaign', 'flow': 'Flow'}
 
     def __unicode__(self):
         return "%s - %s" % (self.uuid, self.org)
@@ -333,7 +898,12 @@ class Message(Document, BaseUtil):
     delivered_on = DateTimeField()
     sent_on = DateTimeField()
 
-    meta = {'collection': 'messages'}
+    meta = {'collection': 'messages', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'tid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+    ]}
+    references = {'broadcast': 'Broadcast', 'contact': 'Contact'}
+    sync_after = ('Label',)
 
     def __unicode__(self):
         return "%s - %s" % (self.text[:7], self.org)
@@ -364,6 +934,70 @@ class FlowStep(EmbeddedDocument, EmbeddedUtil):
         return self.text[:7]
     
 
+# the fields of steps and values as compacted runs store them, one list per field
+PACKED_STEP_FIELDS = ('text', 'value', 'arrived_on', 'left_on')
+PACKED_VALUE_FIELDS = ('category', 'text', 'rule_value', 'label', 'value', 'time')
+EPOCH = datetime(1970, 1, 1)
+
+
+def _offset_ms(value, base):
+    # in integers, going through total_seconds() rounds some offsets down by a millisecond
+    delta = _normalize(value) - base
+    return delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds // 1000
+
+
+def _pack_columns(items, fields, base):
+    columns = dict((field, [item.get(field) for item in items]) for field in fields)
+    for field, column in columns.items():
+        if column and isinstance(next((value for value in column if value is not None), None), datetime):
+            columns[field] = [None if value is None else _offset_ms(value, base) for value in column]
+            columns['%s_offset' % field] = True
+    return columns
+
+
+def _unpack_columns(columns, fields, base):
+    unpacked = []
+    for field in fields:
+        column = columns.get(field) or []
+        if columns.get('%s_offset' % field):
+            column = [None if value is None else base + timedelta(milliseconds=value) for value in column]
+        unpacked.append(column)
+    return [dict(zip(fields, values)) for values in zip(*unpacked)]
+
+
+class FlowNodes(Document):
+    """
+    The node uuids of a flow, in the order they were first seen. Compacted runs store a node as its position in this
+    list, which never changes once given out.
+    """
+    flow = ObjectIdField(required=True, unique=True)
+    nodes = ListField(StringField())
+    meta = {'collection': 'flow_nodes'}
+
+    _cache = LRUCache(1000)
+
+    @classmethod
+    def get_nodes(cls, flow_id, size=0):
+        nodes = cls._cache.get(flow_id)
+        if nodes is None or len(nodes) < size:
+            stored = cls._get_collection().find_one({'flow': flow_id})
+            nodes = stored['nodes'] if stored else []
+            cls._cache.set(flow_id, nodes)
+        return nodes
+
+    @classmethod
+    def encode(cls, flow_id, uuids):
+        nodes = cls.get_nodes(flow_id)
+        missing = [uuid for uuid in OrderedDict.fromkeys(uuids) if uuid not in nodes]
+        if missing:
+            nodes = cls._get_collection().find_and_modify({'flow': flow_id},
+                                                          {'$addToSet': {'nodes': {'$each': missing}}},
+                                                          upsert=True, new=True)['nodes']
+            cls._cache.set(flow_id, nodes)
+        positions = dict((node, i) for i, node in enumerate(nodes))
+        return [positions[uuid] for uuid in uuids]
+
+
 class Run(Document, BaseUtil):
     org = DictField()
     created_on = DateTimeField()
@@ -374,12 +1008,80 @@ class Run(Document, BaseUtil):
     steps = ListField(EmbeddedDocumentField(FlowStep))
     values = ListField(EmbeddedDocumentField(RunValueSet))
     completed = StringField()
+    # None rather than an empty dict, so that runs that are not compacted do not store the field
+    packed = DictField(default=None)
 
-    meta = {'collection': 'runs'}
+    meta = {'collection': 'runs', 'index_background': True, 'indexes': [
+        {'fields': ('org.id', 'tid'), 'unique': True},
+        ('org.id', 'created_on', 'id'),
+        ('flow.id', 'created_on', 'id'),
+    ]}
+    references = {'contact': 'Contact', 'flow': 'Flow'}
 
     def __unicode__(self):
         return "For flow %s - %s" % (self.flow, self.org)
 
+    @classmethod
+    def pack(cls, doc):
+        """
+        The compact form of the steps and values of a stored run: parallel lists per field, datetimes as ms after the
+        run was created and nodes as their position in the flow's FlowNodes.
+        """
+        steps, values = doc.get('steps') or [], doc.get('values') or []
+        base = _normalize(doc.get('created_on') or EPOCH)
+        flow_id = doc['flow']['id']
+        nodes = FlowNodes.encode(flow_id, [item.get('node') for item in steps + values])
+        packed_steps = _pack_columns(steps, PACKED_STEP_FIELDS, base)
+        packed_steps['node'] = nodes[:len(steps)]
+        # step types are one letter codes, kept as a single string
+        types = [item.get('type') for item in steps]
+        packed_steps['type'] = ''.join(types) if all(t and len(t) == 1 for t in types) else types
+        packed_values = _pack_columns(values, PACKED_VALUE_FIELDS, base)
+        packed_values['node'] = nodes[len(steps):]
+        return {'base': base, 'steps': packed_steps, 'values': packed_values}
+
+    def unpack(self):
+        """
+        Fills steps and values back in from the compact form, a run that is not compacted is returned as it is.
+        """
+        if not self.packed or self.steps or self.values:
+            return self
+        base = self.packed['base']
+        packed_steps, packed_values = self.packed['steps'], self.packed['values']
+        positions = packed_steps['node'] + packed_values['node']
+        nodes = FlowNodes.get_nodes(self.flow['id'], max(positions) + 1 if positions else 0)
+        steps = _unpack_columns(packed_steps, PACKED_STEP_FIELDS, base)
+        for step, position, step_type in zip(steps, packed_steps['node'], packed_steps['type']):
+            step.update(node=nodes[position], type=step_type)
+        values = _unpack_columns(packed_values, PACKED_VALUE_FIELDS, base)
+        for value, position in zip(values, packed_values['node']):
+            value['node'] = nodes[position]
+        self.steps = [FlowStep(**step) for step in steps]
+        self.values = [RunValueSet(**value) for value in values]
+        return self
+
+    @classmethod
+    def compact(cls, before, batch_size=None, limit=None):
+        """
+        Compacts runs created before the given date, batch_size at a time, and returns how many were compacted.
+        """
+        collection = cls._get_collection()
+        query = {'created_on': {'$lt': before}, 'flow.id': {'$exists': True},
+                 '$or': [{'steps.0': {'$exists': True}}, {'values.0': {'$exists': True}}]}
+        compacted = 0
+        while limit is None or compacted < limit:
+            size = batch_size or settings.RUN_COMPACT_BATCH
+            batch = list(collection.find(query).limit(size if limit is None else min(size, limit - compacted)))
+            if not batch:
+                break
+            bulk = collection.initialize_unordered_bulk_op()
+            for doc in batch:
+                bulk.find({'_id': doc['_id']}).update_one({'$set': {'packed': cls.pack(doc)},
+                                                           '$unset': {'steps': 1, 'values': 1}})
+            bulk.execute()
+            compacted += len(batch)
+        return compacted
+
     @classmethod
     def get_for_flow(cls, flow_id):
         try:
@@ -407,7 +1109,7 @@ class Result(Document, BaseUtil):
     label = StringField()
     categories = ListField(EmbeddedDocumentField(CategoryStats))
 
-    meta = {'collection': 'results'}
+    meta = {'collection': 'results', 'index_background': True, 'indexes': [('org.id', 'created_on', 'id')]}
 
     def __unicode__(self):
         return "%s - %s" % (self.label, self.org)
@@ -431,7 +1133,11 @@ class Boundary(Document, BaseUtil):
     parent = StringField()
     geometry = ListField(EmbeddedDocumentField(Geometry))
 
-    meta = {'collection': 'boundaries'}
+    meta = {'collection': 'boundaries', 'index_background': True, 'indexes': [('org.id', 'created_on', 'id')]}
+
+
+for _entity in BaseUtil.__subclasses__():
+    _entity.compile_conversion_plan()
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
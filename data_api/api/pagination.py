@@ -0,0 +1,174 @@
+import base64
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from mongoengine import Q
+from data_api.api.utils import get_redis
+
+__author__ = 'kenneth'
+
+
+EPOCH = datetime(1970, 1, 1)
+
+CursorPage = namedtuple('CursorPage', ('items', 'next', 'previous'))
+
+COUNT_STRATEGIES = ('exact', 'cached', 'estimated', 'none')
+
+
+def _to_ms(value):
+    if value is None:
+        return None
+    delta = value.replace(tzinfo=None) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def _from_ms(value):
+    return None if value is None else EPOCH + timedelta(milliseconds=value)
+
+
+class CursorPaginator(object):
+    """
+    Pages through a queryset most recent first, by (created_on, id) instead of by page number. A page continues from
+    the position of the last record of the previous one, so it is found through the (created_on, id) index and costs
+    the same however deep it is.
+    """
+    def __init__(self, queryset, page_size):
+        self.queryset = queryset
+        self.page_size = page_size
+
+    def encode(self, direction, obj):
+        position = json.dumps([direction, _to_ms(obj.created_on), str(obj.id)], separators=(',', ':'))
+        return base64.urlsafe_b64encode(position).rstrip('=')
+
+    def decode(self, token):
+        try:
+            direction, created_on, obj_id = json.loads(base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4)))
+            if direction not in ('n', 'p'):
+                raise ValueError
+            return direction, _from_ms(created_on), ObjectId(obj_id)
+        except (TypeError, ValueError, InvalidId):
+            raise ValueError("Invalid cursor")
+
+    def get_older(self, created_on, obj_id):
+        # records without created_on sort last
+        if created_on is None:
+            return Q(created_on=None, id__lt=obj_id)
+        return Q(created_on__lt=created_on) | Q(created_on=None) | Q(created_on=created_on, id__lt=obj_id)
+
+    def get_newer(self, created_on, obj_id):
+        if created_on is None:
+            return Q(created_on__ne=None) | Q(created_on=None, id__gt=obj_id)
+        return Q(created_on__gt=created_on) | Q(created_on=created_on, id__gt=obj_id)
+
+    def get_page(self, token=None):
+        if not token:
+            items = list(self.queryset.order_by('-created_on', '-id')[:self.page_size + 1])
+            return CursorPage(items[:self.page_size], self.encode('n', items[self.page_size - 1])
+                              if len(items) > self.page_size else None, None)
+        direction, created_on, obj_id = self.decode(token)
+        if direction == 'n':
+            items = list(self.queryset.filter(self.get_older(created_on, obj_id))
+                         .order_by('-created_on', '-id')[:self.page_size + 1])
+            more, items = len(items) > self.page_size, items[:self.page_size]
+            return CursorPage(items, self.encode('n', items[-1]) if more else None,
+                              self.encode('p', items[0]) if items else None)
+        items = list(self.queryset.filter(self.get_newer(created_on, obj_id))
+                     .order_by('created_on', 'id')[:self.page_size + 1])
+        more, items = len(items) > self.page_size, items[:self.page_size][::-1]
+        return CursorPage(items, self.encode('n', items[-1]) if items else None,
+                          self.encode('p', items[0]) if more else None)
+
+
+def get_count_generation(entity, org):
+    return int(get_redis().get('count-generation:%s:%s' % (entity, org)) or 0)
+
+
+def bump_count_generation(entity, org):
+    """
+    Invalidates the cached counts of an entity for an org, called whenever records of it are written.
+    """
+    get_redis().incr('count-generation:%s:%s' % (entity, org))
+
+
+class UncountedPage(Page):
+    def __init__(self, object_list, number, paginator, has_more):
+        super(UncountedPage, self).__init__(object_list, number, paginator)
+        self.has_more = has_more
+
+    def __repr__(self):
+        return '<Page %s>' % self.number
+
+    def has_next(self):
+        return self.has_more
+
+    def next_page_number(self):
+        return self.number + 1
+
+
+class CountPaginator(Paginator):
+    """
+    A Paginator whose count depends on strategy:
+
+    * exact - counts the matching records on every request
+    * cached - counts them once and keeps the count under cache_key for COUNT_CACHE_TTL seconds
+    * estimated - counts no further than COUNT_ESTIMATE_MAX, which then means at least that many
+    * none - does not count, the count is null
+
+    Only exact and cached use the count to find the last page, the others fetch one record more than a page to find
+    out whether there is a next one.
+    """
+    def __init__(self, object_list, per_page, strategy='exact', cache_key=None, **kwargs):
+        super(CountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.strategy = strategy
+        self.cache_key = cache_key
+
+    def _get_count(self):
+        if self._count is None:
+            if self.strategy == 'cached':
+                self._count = self.get_cached_count()
+            elif self.strategy == 'estimated':
+                self._count = self.object_list.limit(settings.COUNT_ESTIMATE_MAX).count(with_limit_and_skip=True)
+            elif self.strategy == 'exact':
+                self._count = super(CountPaginator, self)._get_count()
+        return self._count
+    count = property(_get_count)
+
+    def _get_num_pages(self):
+        # the last page is unknown, asking for it ends up as a 404
+        if self.strategy not in ('exact', 'cached'):
+            return None
+        return super(CountPaginator, self)._get_num_pages()
+    num_pages = property(_get_num_pages)
+
+    def get_cached_count(self):
+        cached = get_redis().get(self.cache_key)
+        if cached is not None:
+            return int(cached)
+        count = self.object_list.count()
+        get_redis().setex(self.cache_key, settings.COUNT_CACHE_TTL, count)
+        return count
+
+    def page(self, number):
+        if self.strategy in ('exact', 'cached'):
+            return super(CountPaginator, self).page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        items = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not items and number > 1:
+            raise EmptyPage('That page contains no results')
+        return UncountedPage(items[:self.per_page], number, self, len(items) > self.per_page)
+
+    def validate_number(self, number):
+        if self.strategy in ('exact', 'cached'):
+            return super(CountPaginator, self).validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
@@ -22,4 +22,8 @@ class MessageAccessPermissions(EntityAccessPermissions):
 
 
 class OrgAccessPermissions(EntityAccessPermissions):
-    _group = getattr(settings, 'ORG_ACCESS_GROUP', "org_access")
\ No newline at end of file
+    _group = getattr(settings, 'ORG_ACCESS_GROUP', "org_access")
+
+
+class SyncAccessPermissions(EntityAccessPermissions):
+    _group = getattr(settings, 'SYNC_ACCESS_GROUP', "sync_access")
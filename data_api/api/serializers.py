@@ -1,6 +1,7 @@
 from rest_framework.fields import SerializerMethodField
 from rest_framework_mongoengine import serializers
-from data_api.api.models import Run, Flow, Contact, FlowStep, RunValueSet, Org, Message, Broadcast, Campaign, Event
+from data_api.api.models import Run, Flow, Contact, FlowStep, RunValueSet, Org, Message, Broadcast, Campaign, Event, \
+    SyncRun, SyncStep, Group
 
 __author__ = 'kenneth'
 
@@ -11,11 +12,44 @@ ALWAYS_EXCLUDE = ('org', 'modified_on')
 class BaseDocumentSerializer(serializers.DocumentSerializer):
     org_id = SerializerMethodField()
 
+    # the document fields each serializer field is read from, when they are not the field of the same name
+    model_fields = {'org_id': ('org',)}
+
+    @classmethod
+    def get_model_fields(cls, names):
+        model = cls.Meta.model
+        fields = set()
+        for name in names:
+            fields.update(cls.model_fields.get(name, (name,) if name in model._fields else ()))
+        return fields
+
+    def get_fields(self):
+        """
+        Drops the fields left out with ?fields= or ?exclude=, which the view passes on in the context.
+        """
+        fields = super(BaseDocumentSerializer, self).get_fields()
+        requested, excluded = self.context.get('fields'), self.context.get('exclude')
+        for name in list(fields.keys()):
+            if (requested and name not in requested) or (excluded and name in excluded):
+                del fields[name]
+        return fields
+
     def get_org_id(self, obj):
         if obj.org:
             return unicode(obj.org['id'])
         return None
 
+    def get_names(self, model, references):
+        """
+        References only hold the id, the names are looked up once per request for all the records serialized.
+        """
+        names = self.context.setdefault('names', {}).setdefault(model.__name__, {})
+        ids = [ref['id'] for ref in references if isinstance(ref, dict) and 'id' in ref]
+        missing = [i for i in set(ids) if i not in names]
+        if missing:
+            names.update((obj.id, obj.name) for obj in model.objects.filter(id__in=missing).only('id', 'name'))
+        return [names.get(i) for i in ids]
+
 
 class OrgReadSerializer(serializers.DocumentSerializer):
     class Meta:
@@ -104,6 +138,7 @@ class RunValueSetReadSerializer(serializers.EmbeddedDocumentSerializer):
 class ContactReadSerializer(BaseDocumentSerializer):
     groups = SerializerMethodField()
     contact_fields = SerializerMethodField('get_eval_fields')
+    model_fields = dict(BaseDocumentSerializer.model_fields, contact_fields=('fields',))
 
     class Meta:
         model = Contact
@@ -111,7 +146,7 @@ class ContactReadSerializer(BaseDocumentSerializer):
 
     def get_groups(self, obj):
         if obj.groups:
-            return [g.get('name') for g in obj.groups if isinstance(g, dict)]
+            return self.get_names(Group, obj.groups)
         return []
 
     def get_eval_fields(self, obj):
@@ -124,11 +159,17 @@ class RunReadSerializer(BaseDocumentSerializer):
     contact_id = SerializerMethodField()
     flow_id = SerializerMethodField()
     completed = SerializerMethodField()
+    # compacted runs need packed and the flow to unpack their steps and values
+    model_fields = dict(BaseDocumentSerializer.model_fields, contact_id=('contact',), flow_id=('flow',),
+                        steps=('steps', 'packed', 'flow'), values=('values', 'packed', 'flow'))
 
     class Meta:
         model = Run
         depth = 3
-        exclude = ('tid', 'modified_on', 'contact', 'flow', 'org')
+        exclude = ('tid', 'modified_on', 'contact', 'flow', 'org', 'packed')
+
+    def to_representation(self, instance):
+        return super(RunReadSerializer, self).to_representation(instance.unpack())
 
     def update(self, instance, validated_data):
         values = validated_data.pop('values')
@@ -192,12 +233,12 @@ class BroadcastReadSerializer(BaseDocumentSerializer):
 
     def get_groups(self, obj):
         if obj.groups:
-            return [g['name'] for g in obj.groups]
+            return self.get_names(Group, obj.groups)
         return []
 
     def get_contacts(self, obj):
         if obj.contacts:
-            return [c['name'] for c in obj.contacts]
+            return self.get_names(Contact, obj.contacts)
         return []
 
 
@@ -227,3 +268,17 @@ class EventReadSerializer(BaseDocumentSerializer):
         return str(obj.campaign.get('id', '')) or None
 
 
+class SyncStepReadSerializer(BaseDocumentSerializer):
+    class Meta:
+        model = SyncStep
+        exclude = ('org', 'run')
+
+
+class SyncRunReadSerializer(serializers.DocumentSerializer):
+    steps = SerializerMethodField()
+
+    class Meta:
+        model = SyncRun
+
+    def get_steps(self, obj):
+        return SyncStepReadSerializer(obj.get_steps(), many=True).data
@@ -1,10 +1,24 @@
+from collections import OrderedDict
 import logging
+import Queue
+import sys
+import threading
+import time
 import traceback
+from datetime import datetime
+from bson import ObjectId
+from celery import chord
+from celery.exceptions import Retry
 from django.conf import settings
 import requests
 from retrying import retry
+from temba import types
 from temba.base import TembaAPIError, TembaConnectionError, TembaException, TembaPager
-from data_api.api.models import BaseUtil, Org
+from data_api.api.clients import get_retry_after
+from data_api.api.locks import Lease, Semaphore
+from data_api.api.models import BaseUtil, FailedPage, LastSaved, Org, SyncRun, SyncStep, reference_cache
+from data_api.api.pagination import bump_count_generation
+from data_api.api.webhooks import WebhookBuffer
 from djcelery_transactions import task
 
 __author__ = 'kenneth'
@@ -14,44 +28,419 @@ logger = logging.getLogger("tasks")
 
 
 def retry_if_temba_api_or_connection_error(exception):
+    retry_after = get_retry_after(exception)
+    if retry_after is not None:
+        logger.warning("Throttled by Temba: %s - Retrying in %s seconds", str(exception), str(retry_after))
+        return True
     if isinstance(exception, TembaAPIError) and isinstance(exception.caused_by,
                                                            requests.HTTPError
                                                            ) and 399 < exception.caused_by.response.status_code < 500:
         return False
     if isinstance(exception, TembaAPIError) or isinstance(exception, TembaConnectionError):
-        logger.warning("Raised an exception: %s - Retrying in %s minutes", str(exception),
-                   str(settings.RETRY_WAIT_FIXED/60000))
+        logger.warning("Raised an exception: %s - Retrying with backoff", str(exception))
         return True
     return False
 
 
 @retry(retry_on_exception=retry_if_temba_api_or_connection_error, stop_max_attempt_number=settings.RETRY_MAX_ATTEMPTS,
-       wait_fixed=settings.RETRY_WAIT_FIXED)
-def fetch_entity(entity, org, n):
-    entity = entity.get('name')
-    logger.info("Fetching Object of type: %s for Org: %s on Page %s", str(entity), org.name, str(n))
-    entity.fetch_objects(org, pager=TembaPager(n))
+       wait_exponential_multiplier=settings.RETRY_WAIT_MULTIPLIER, wait_exponential_max=settings.RETRY_WAIT_MAX,
+       wait_jitter_max=settings.RETRY_WAIT_JITTER)
+def fetch_page(entity, org, n, cursor, step):
+    logger.info("Fetching Object of type: %s for Org: %s on Page %s", str(entity['name']), org.name, str(n))
+    pager = TembaPager(n)
+    started = time.time()
+    try:
+        temba_list = entity['name'].fetch_page(org, pager=pager, after=cursor.last_saved)
+    except Exception:
+        step.errors += 1
+        raise
+    finally:
+        step.record_fetch(time.time() - started)
+    return temba_list, pager.has_more()
+
+
+def ingest_page(entity, org, n, temba_list, cursor, step):
+    bulk = entity.get('bulk', settings.SYNC_BULK_UPSERT)
+    update = entity.get('update', settings.SYNC_UPDATE_EXISTING)
+    cursor.track(temba_list)
+    result = entity['name'].ingest_page(org, temba_list, bulk=bulk, update=update)
+    cursor.checkpoint(n)
+    step.record_page(result)
+    logger.info("Page %s of %s for Org: %s - inserted: %s, updated: %s, unchanged: %s", str(n),
+                str(entity['name']), org.name, result['inserted'], result['updated'], result['unchanged'])
+
+
+def fetch_entity(entity, org, n, cursor, step):
+    temba_list, has_more = fetch_page(entity, org, n, cursor, step)
+    ingest_page(entity, org, n, temba_list, cursor, step)
+    return has_more
+
+
+def is_past_last_page(exception, n):
+    return n > 1 and isinstance(exception, TembaAPIError) and isinstance(exception.caused_by, requests.HTTPError) \
+        and exception.caused_by.response is not None and exception.caused_by.response.status_code == 404
+
+
+def set_aside_page(entity, org, n, cursor, step, exc_info):
+    """
+    Records a page that failed for retry_failed_pages and moves the cursor past it, so the sync can go on with the
+    next page. The pass then leaves last_saved where it was. Gives up on the sync by re-raising once
+    SYNC_MAX_PAGE_FAILURES pages in a row have failed.
+    """
+    error = ''.join(traceback.format_exception_only(exc_info[0], exc_info[1])).strip()
+    logger.error("Page %s of %s for Org: %s failed, setting it aside: %s", str(n), str(entity['name']), org.name,
+                 error)
+    FailedPage.record(org, entity['name'].__name__, n, cursor.last_saved, error)
+    cursor.set_aside(n)
+    step.record_failed_page()
+    if step.consecutive_failures >= settings.SYNC_MAX_PAGE_FAILURES:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def fetch_pages(entity, org, n, step, cursor):
+    while True:
+        try:
+            has_more = fetch_entity(entity, org, n, cursor, step)
+        except Exception as e:
+            if is_past_last_page(e, n):
+                return
+            set_aside_page(entity, org, n, cursor, step, sys.exc_info())
+            has_more = True
+        if not has_more:
+            return
+        n += 1
+
+
+def fetch_pages_pipelined(entity, org, n, step, cursor, depth):
+    """
+    Fetches upcoming pages on a separate thread while the current one is written. At most depth fetched pages wait
+    in the queue, so the fetcher blocks whenever Mongo falls behind.
+    """
+    pages = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def fetcher(page):
+        try:
+            while not stop.is_set():
+                temba_list, has_more, exc_info = None, True, None
+                try:
+                    temba_list, has_more = fetch_page(entity, org, page, cursor, step)
+                except Exception as e:
+                    if is_past_last_page(e, page):
+                        break
+                    exc_info = sys.exc_info()
+                if not put((page, temba_list, exc_info)) or not has_more:
+                    break
+                page += 1
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=fetcher, args=(n,))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is None:
+                return
+            page, temba_list, exc_info = item
+            if not exc_info:
+                try:
+                    ingest_page(entity, org, page, temba_list, cursor, step)
+                    continue
+                except Exception:
+                    exc_info = sys.exc_info()
+            set_aside_page(entity, org, page, cursor, step, exc_info)
+    finally:
+        stop.set()
+
+
+def sync_entity(entity, org, run_id=None):
+    step = SyncStep(run=run_id, org=dict(id=org.id, name=org.name), entity=entity['name'].__name__,
+                    started_on=datetime.utcnow())
+    step.save()
+    status = 'completed'
+    with reference_cache() as cache:
+        try:
+            cursor = entity['name'].get_cursor(org)
+            n = entity.get('start_page') or cursor.page or 1
+            if n > 1:
+                logger.info("Resuming %s for Org: %s from Page %s", str(entity['name']), org.name, str(n))
+            depth = entity.get('prefetch', settings.SYNC_PREFETCH_DEPTH)
+            if depth:
+                fetch_pages_pipelined(entity, org, n, step, cursor, depth)
+            else:
+                fetch_pages(entity, org, n, step, cursor)
+            cursor.complete()
+        except TembaException as e:
+            logger.error("Temba is misbehaving: %s - No retry", str(e))
+            status = 'failed'
+        except Exception as e:
+            logger.error("Things are dead: %s - No retry", str(traceback.format_exc()))
+            step.errors += 1
+            status = 'failed'
+        logger.info("Reference cache - size: %(size)s, hits: %(hits)s, misses: %(misses)s", cache.stats())
+    step.finish(status)
+    if step.inserted:
+        bump_count_generation(step.entity, org.id)
+    return dict(org=str(org.id), entity=step.entity, pages=step.pages, status=step.status)
+
+
+def skip_entity(entity, org, run_id=None):
+    logger.info("%s for Org: %s is already being synced - Skipping", str(entity['name']), org.name)
+    step = SyncStep(run=run_id, org=dict(id=org.id, name=org.name), entity=entity['name'].__name__,
+                    started_on=datetime.utcnow())
+    step.finish('skipped')
+    return dict(org=str(org.id), entity=step.entity, pages=0, status=step.status)
+
+
+def fail_entity(org_id, entity, run_id=None):
+    step = SyncStep(run=run_id, org=dict(id=ObjectId(org_id)), entity=entity['name'], started_on=datetime.utcnow())
+    step.errors += 1
+    step.finish('failed')
+    return dict(org=str(org_id), entity=step.entity, pages=0, status=step.status)
+
+
+@task(bind=True, max_retries=None)
+def fetch_org_entity(self, org_id, entity, run_id=None):
+    # an error here would keep the chord callback from running, and the sync run would never finish
+    try:
+        return run_org_entity(self, org_id, entity, run_id)
+    except Retry:
+        raise
+    except Exception:
+        logger.error("Could not sync %s for Org: %s - %s", entity['name'], org_id, traceback.format_exc())
+        return fail_entity(org_id, entity, run_id)
+
+
+def run_org_entity(task, org_id, entity, run_id=None):
+    org = Org.objects.get(id=org_id)
+    entity = dict(entity, name=BaseUtil.get_entity(entity['name']))
+    lease = Lease('sync:%s:%s' % (org_id, entity['name'].__name__), settings.SYNC_LEASE_TTL)
+    if not lease.acquire():
+        if settings.SYNC_LEASE_CONFLICT == 'wait':
+            raise task.retry(countdown=settings.SYNC_SLOT_RETRY)
+        return skip_entity(entity, org, run_id)
+    sync_slots = Semaphore('sync', settings.SYNC_MAX_CONCURRENCY, settings.SYNC_SLOT_TIMEOUT)
+    org_slots = Semaphore('sync:%s' % org_id, org.sync_concurrency or settings.SYNC_ORG_CONCURRENCY,
+                          settings.SYNC_SLOT_TIMEOUT)
+    sync_token = sync_slots.acquire()
+    org_token = sync_token and org_slots.acquire()
+    if not org_token:
+        if sync_token:
+            sync_slots.release(sync_token)
+        lease.release()
+        raise task.retry(countdown=settings.SYNC_SLOT_RETRY)
+    try:
+        with lease.kept_alive((sync_slots, sync_token), (org_slots, org_token)):
+            return sync_entity(entity, org, run_id)
+    finally:
+        org_slots.release(org_token)
+        sync_slots.release(sync_token)
+
+
+def plan_sync(entities):
+    """
+    Orders entities into levels so that every entity is synced after the entities it references. Entities in the
+    same level do not depend on each other and can run in parallel. References to entities that are not part of this
+    sync are ignored.
+    """
+    entities = OrderedDict((entity['name'], entity) for entity in entities)
+    pending = dict((name, BaseUtil.get_entity(name).get_dependencies().intersection(entities))
+                   for name in entities)
+    levels = []
+    while pending:
+        level = [name for name in entities if name in pending and not pending[name]]
+        if not level:
+            raise ValueError("Circular references between %s" % ", ".join(sorted(pending)))
+        for name in level:
+            del pending[name]
+        for dependencies in pending.values():
+            dependencies.difference_update(level)
+        levels.append([entities[name] for name in level])
+    return levels
+
+
+@task
+def sync_org(org_id, levels, run_id=None):
+    if levels:
+        units = [fetch_org_entity.si(org_id, entity, run_id) for entity in levels[0]]
+        chord(units)(sync_org.si(org_id, levels[1:], run_id))
+    elif run_id and SyncRun.org_done(run_id):
+        sync_summary.delay(run_id)
+
+
+@task
+def sync_summary(run_id):
+    run = SyncRun.objects.get(id=run_id)
+    run.finish()
+    logger.info("Sync %s finished: %s org entities, %s pages, %s failed", str(run.id), run.step_count, run.pages,
+                run.failed_count)
+    for step in run.get_steps().filter(status='failed'):
+        logger.warning("Sync of %s for Org: %s failed after %s pages", step.entity, step.org.get('name'),
+                       step.pages)
+
+
+@task
+def retry_failed_pages():
+    slots = Semaphore('failed-pages', 1, settings.SYNC_SLOT_TIMEOUT)
+    token = slots.acquire()
+    if not token:
+        logger.info("Failed pages are already being retried")
+        return
+    try:
+        for failed in FailedPage.get_due():
+            retry_failed_page(failed)
+    finally:
+        slots.release(token)
+
+
+def retry_failed_page(failed):
+    org = Org.objects.filter(id=failed.org['id']).first()
+    if org is None:
+        failed.delete()
+        return
+    entity = BaseUtil.get_entity(failed.entity)
+    try:
+        with reference_cache():
+            temba_list = entity.fetch_page(org, pager=TembaPager(failed.page), after=failed.after)
+            result = entity.ingest_page(org, temba_list, bulk=settings.SYNC_BULK_UPSERT, update=True)
+    except Exception as e:
+        failed.retry_later(str(e))
+        logger.warning("Retry %s of Page %s of %s for Org: %s failed: %s", failed.attempts, str(failed.page),
+                       failed.entity, org.name, str(e))
+        return
+    if result['inserted']:
+        bump_count_generation(failed.entity, org.id)
+    logger.info("Recovered Page %s of %s for Org: %s - inserted: %s, updated: %s, unchanged: %s", str(failed.page),
+                failed.entity, org.name, result['inserted'], result['updated'], result['unchanged'])
+    failed.delete()
+
+
+# contacts first, runs and messages reference them
+WEBHOOK_ENTITIES = ('Contact', 'Message', 'Run')
+
+
+def queue_webhook_events(org, events):
+    """
+    Buffers the events of a webhook call, flushing the buffer once it holds WEBHOOK_BATCH_SIZE events and at most
+    WEBHOOK_FLUSH_INTERVAL ms after the first event was buffered.
+    """
+    buffer = WebhookBuffer()
+    if buffer.push(str(org.id), events) >= settings.WEBHOOK_BATCH_SIZE:
+        flush_webhooks.delay()
+    elif buffer.schedule_flush(settings.WEBHOOK_FLUSH_INTERVAL):
+        flush_webhooks.apply_async(countdown=settings.WEBHOOK_FLUSH_INTERVAL / 1000.0)
+
+
+@task
+def flush_webhooks():
+    """
+    Writes the buffered webhook events. The events of a batch that cannot be written are written one at a time, those
+    that still fail go back to the buffer and another flush is scheduled WEBHOOK_RETRY_WAIT seconds later.
+    """
+    buffer = WebhookBuffer()
+    failed = []
+    while True:
+        events = buffer.pop(settings.WEBHOOK_BATCH_SIZE)
+        if not events:
+            break
+        try:
+            write_webhook_events(events)
+        except Exception:
+            for event in events:
+                try:
+                    write_webhook_events([event])
+                except Exception:
+                    logger.warning("Webhook %s event for Org: %s failed: %s", event[1], event[0],
+                                   traceback.format_exc())
+                    failed.append(event)
+    if failed:
+        dead = buffer.requeue(failed, settings.WEBHOOK_MAX_ATTEMPTS)
+        if dead:
+            logger.error("%s webhook events failed %s times, moved to %s", dead, settings.WEBHOOK_MAX_ATTEMPTS,
+                         buffer.dead_key)
+        if len(failed) > dead and buffer.schedule_flush(settings.WEBHOOK_RETRY_WAIT * 1000):
+            flush_webhooks.apply_async(countdown=settings.WEBHOOK_RETRY_WAIT)
+
+
+def write_webhook_events(events):
+    grouped = OrderedDict()
+    # requeued events carry their attempts after the item
+    for org_id, entity, item in (event[:3] for event in events):
+        grouped.setdefault(org_id, dict((name, []) for name in WEBHOOK_ENTITIES))[entity].append(item)
+    with reference_cache():
+        for org_id, entities in grouped.items():
+            org = Org.objects.filter(id=org_id).first()
+            if org is None:
+                continue
+            for name in WEBHOOK_ENTITIES:
+                if not entities[name]:
+                    continue
+                entity = BaseUtil.get_entity(name)
+                temba_list = [getattr(types, name).deserialize(item) for item in entities[name]]
+                # webhooks only carry part of a contact or message, the stored one is left to the poller
+                result = entity.bulk_upsert_from_temba_list(org, temba_list, update=name == 'Run')
+                if result['inserted']:
+                    bump_count_generation(name, org.id)
+                logger.info("Webhook %s for Org: %s - inserted: %s, updated: %s, unchanged: %s", name, org.name,
+                            result['inserted'], result['updated'], result['unchanged'])
+
+
+@task
+def sync_due():
+    """
+    Queues an incremental sync of every (org, entity) whose cadence has elapsed since it was last queued.
+    """
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    due = OrderedDict()
+    for org in Org.objects.filter(is_active=True):
+        for cls in BaseUtil.__subclasses__():
+            if cls.get_cursor(org).is_due(org.get_cadence(cls.__name__), now):
+                LastSaved.mark_dispatched(org, cls._meta['collection'], now)
+                due.setdefault(str(org.id), []).append(dict(name=cls.__name__))
+    if not due:
+        return
+    entities = sorted(set(entity['name'] for org_entities in due.values() for entity in org_entities))
+    run = SyncRun.objects.create(started_on=datetime.utcnow(), entities=entities, pending_orgs=len(due))
+    logger.info("Started sync run %s of due entities for %s orgs", str(run.id), len(due))
+    for org_id, org_entities in due.items():
+        sync_org.delay(org_id, plan_sync(org_entities), str(run.id))
+
+
+@task
+def compact_org_references(entities=None, batch_size=None):
+    for name in entities or [cls.__name__ for cls in BaseUtil.__subclasses__()]:
+        compacted = BaseUtil.get_entity(name).compact_org_references(batch_size)
+        logger.info("Compacted the org of %s %s records", compacted, name)
 
 
 @task
 def fetch_all(entities=None, orgs=None):
-    print "Started Here"
     if not entities:
         entities = [dict(name=cls) for cls in BaseUtil.__subclasses__()]
     if not orgs:
-        orgs = Org.objects.all({"is_active": True})
+        orgs = Org.objects.filter(is_active=True)
     else:
         orgs = [Org.objects.get(**{'api_token': api_key}) for api_key in orgs]
     assert iter(entities)
-    for org in orgs:
-        for entity in entities:
-            try:
-                n = entity.get('start_page', 1)
-                while True:
-                    fetch_entity(entity, org, n)
-                    n += 1
-            except TembaException as e:
-                logger.error("Temba is misbehaving: %s - No retry", str(e))
-                continue
-            except Exception as e:
-                logger.error("Things are dead: %s - No retry", str(traceback.format_exc()))
+    entities = [dict(entity, name=getattr(entity['name'], '__name__', entity['name'])) for entity in entities]
+    orgs = [str(org.id) for org in orgs]
+    if not orgs or not entities:
+        return
+    levels = plan_sync(entities)
+    run = SyncRun.objects.create(started_on=datetime.utcnow(), entities=[entity['name'] for entity in entities],
+                                 pending_orgs=len(orgs))
+    logger.info("Started sync run %s for %s orgs: %s", str(run.id), len(orgs),
+                " -> ".join(", ".join(entity['name'] for entity in level) for level in levels))
+    for org_id in orgs:
+        sync_org.delay(org_id, levels, str(run.id))
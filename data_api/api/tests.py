@@ -1,7 +1,32 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+from bson import DBRef, ObjectId
+from StringIO import StringIO
+from django.conf import settings
+from django.core.management import call_command
+from django.core.paginator import EmptyPage
 from django.utils import unittest
+import pytz
+import requests
+from rest_framework.test import APIRequestFactory
+from temba.base import TembaAPIError
+from temba import types
+from data_api.api import models, tasks
+from data_api.api.clients import get_retry_after, TembaClientPool
+from data_api.api.fake_rapidpro import FakeData
+from data_api.api.locks import Lease, Semaphore
+from data_api.api.webhooks import WebhookBuffer, WebhookError, parse_event
+from data_api.api.management.commands.benchmark_conversion import build_reflective
+from data_api.api.management.commands.import_rapidpro import Command as ImportCommand
 from data_api.api.models import Org, Urn, Group, Contact, Broadcast, Campaign, Flow, Event, Label, Message, Run, \
-    Boundary, Result
+    Boundary, Result, LastSaved, SyncRun, SyncStep, FailedPage, FlowStep, RunValueSet, reference_cache
+from data_api.api.pagination import CountPaginator, CursorPaginator
+from data_api.api.serializers import RunReadSerializer, ContactReadSerializer
+from data_api.api.tasks import fetch_org_entity, flush_webhooks, plan_sync
+from data_api.api.utils import LRUCache, get_redis
+from data_api.api.views import WebhookEvents
 
 __author__ = 'kenneth'
 
@@ -95,3 +120,664 @@ class TestModels(unittest.TestCase):
         result = Result.create_from_temba(self.org, self.temba_result)
         self.assertEqual(result_count+1, Result.objects.count())
         self.assertEqual(result.categories[0].label, self.temba_category_stats.label)
+
+    def test_bulk_upsert_from_temba_list(self):
+        def counts(stats):
+            return stats['inserted'], stats['updated'], stats['unchanged']
+
+        temba_groups = [FakeTemba(uuid='bulk-group-%d' % i, name='bulk_group_%d' % i, size=i) for i in range(3)]
+        Group.objects.filter(uuid__in=[g.uuid for g in temba_groups]).delete()
+        self.assertEqual(counts(Group.bulk_upsert_from_temba_list(self.org, list(temba_groups))), (3, 0, 0))
+        self.assertEqual(counts(Group.bulk_upsert_from_temba_list(self.org, list(temba_groups))), (0, 0, 3))
+        temba_groups[0] = FakeTemba(uuid='bulk-group-0', name='bulk_group_0', size=10)
+        self.assertEqual(counts(Group.bulk_upsert_from_temba_list(self.org, list(temba_groups))), (0, 0, 3))
+        stats = Group.bulk_upsert_from_temba_list(self.org, list(temba_groups), update=True)
+        self.assertEqual(counts(stats), (0, 1, 2))
+        self.assertEqual(Group.objects.get(uuid=temba_groups[0].uuid).size, 10)
+        # a value Temba cleared is unset rather than kept
+        temba_groups[1] = FakeTemba(uuid='bulk-group-1', name='bulk_group_1', size=None)
+        stats = Group.bulk_upsert_from_temba_list(self.org, list(temba_groups), update=True)
+        self.assertEqual(counts(stats), (0, 1, 2))
+        self.assertNotIn('size', Group._get_collection().find_one({'uuid': 'bulk-group-1'}))
+        self.assertEqual(counts(Group.bulk_upsert_from_temba_list(self.org, [])), (0, 0, 0))
+
+    def test_reference_cache(self):
+        Group.objects.filter(uuid='cached-group').delete()
+        group = Group.create_from_temba(self.org, FakeTemba(uuid='cached-group', name='cached_group', size=1))
+        with reference_cache(max_size=2) as cache:
+            self.assertEqual(Group.get_or_fetch(self.org, group.uuid).id, group.id)
+            self.assertEqual(Group.get_or_fetch(self.org, group.uuid).id, group.id)
+            self.assertEqual([g.id for g in Group.get_objects_from_uuids(self.org, [group.uuid])], [group.id])
+            self.assertEqual(cache.stats(), dict(size=1, hits=2, misses=1))
+        self.assertIsNone(models._reference_cache)
+
+    def test_lru_cache_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), dict(size=2, hits=3, misses=1))
+
+    def test_sync_cursor(self):
+        LastSaved.objects.filter(**{'coll': 'test_cursor', 'org.id': self.org.id}).delete()
+        cursor = LastSaved.get_for(self.org, 'test_cursor')
+        cursor.checkpoint(1, [FakeTemba(uuid='a', created_on=datetime(2016, 1, 2)),
+                              FakeTemba(uuid='b', modified_on=datetime(2016, 1, 5))])
+        cursor = LastSaved.get_for(self.org, 'test_cursor')
+        self.assertEqual(cursor.page, 2)
+        self.assertIsNone(cursor.last_saved)
+        cursor.checkpoint(2, [FakeTemba(uuid='c', created_on=datetime(2016, 1, 3))])
+        cursor.complete()
+        cursor = LastSaved.get_for(self.org, 'test_cursor')
+        self.assertIsNone(cursor.page)
+        self.assertEqual(cursor.last_saved, datetime(2016, 1, 5))
+
+    def test_sync_cursor_is_held_by_pages_set_aside(self):
+        LastSaved.objects.filter(**{'coll': 'test_cursor', 'org.id': self.org.id}).delete()
+        cursor = LastSaved.get_for(self.org, 'test_cursor')
+        cursor.checkpoint(1, [FakeTemba(uuid='a', modified_on=datetime(2016, 1, 5))])
+        cursor.set_aside(2)
+        cursor.complete()
+        cursor = LastSaved.get_for(self.org, 'test_cursor')
+        self.assertIsNone(cursor.last_saved)
+        self.assertEqual((cursor.page, cursor.pages_set_aside), (None, 0))
+
+        # the next pass fetches the records of the page again and moves on
+        cursor.checkpoint(1, [FakeTemba(uuid='a', modified_on=datetime(2016, 1, 5))])
+        cursor.complete()
+        self.assertEqual(LastSaved.get_for(self.org, 'test_cursor').last_saved, datetime(2016, 1, 5))
+        cursor.delete()
+
+    def test_sync_cursor_is_stored(self):
+        LastSaved.objects.filter(**{'coll': 'test_cursor', 'org.id': self.org.id}).delete()
+        LastSaved.get_for(self.org, 'test_cursor').checkpoint(4, [FakeTemba(uuid='a', created_on=datetime(2016, 1, 2))])
+        stored = LastSaved._get_collection().find_one({'coll': 'test_cursor', 'org.id': self.org.id})
+        self.assertEqual(stored['org'], dict(id=self.org.id, name=self.org.name))
+        self.assertEqual(stored['page'], 5)
+        self.assertEqual(LastSaved.get_for(self.org, 'test_cursor').id, stored['_id'])
+
+    def test_sync_cadence(self):
+        self.org.sync_cadences = {'Flow': 30, 'Label': 0}
+        self.assertEqual(self.org.get_cadence('Flow'), 30)
+        self.assertEqual(self.org.get_cadence('Label'), 0)
+        self.assertEqual(self.org.get_cadence('Message'), settings.SYNC_CADENCES['Message'])
+        LastSaved.objects.filter(**{'coll': 'test_cadence', 'org.id': self.org.id}).delete()
+        now = datetime(2016, 1, 1, 12, 0)
+        self.assertTrue(LastSaved.get_for(self.org, 'test_cadence').is_due(30, now))
+        LastSaved.mark_dispatched(self.org, 'test_cadence', now)
+        cursor = LastSaved.get_for(self.org, 'test_cadence')
+        self.assertFalse(cursor.is_due(30, now + timedelta(minutes=29)))
+        self.assertTrue(cursor.is_due(30, now + timedelta(minutes=30)))
+        self.assertFalse(cursor.is_due(0, now + timedelta(days=1)))
+        cursor.delete()
+
+    def test_get_changes(self):
+        stored = {'_id': 1, 'name': 'a', 'modified_on': datetime(2016, 1, 1, 10, 0, 0, 123000)}
+        same_ms = datetime(2016, 1, 1, 10, 0, 0, 123456)
+        self.assertEqual(Contact.get_changes(stored, {'name': 'b', 'modified_on': same_ms}), {})
+        self.assertEqual(Contact.get_changes(stored, {'name': 'b', 'modified_on': datetime(2016, 1, 2)}),
+                         {'$set': {'name': 'b', 'modified_on': datetime(2016, 1, 2)}})
+        self.assertEqual(Group.get_changes({'_id': 1, 'name': 'a', 'size': 1}, {'name': 'a', 'size': 2}),
+                         {'$set': {'size': 2}})
+        # fields Temba cleared are missing from the incoming document, fields the model does not declare are kept
+        cleared = Contact.get_changes(dict(stored, language='eng', extra=1), {'modified_on': datetime(2016, 1, 2)})
+        self.assertEqual(cleared, {'$set': {'modified_on': datetime(2016, 1, 2)},
+                                   '$unset': {'name': '', 'language': ''}})
+
+    def test_get_retry_after(self):
+        response = requests.Response()
+        response.status_code = 429
+        response.headers['Retry-After'] = '30'
+        self.assertEqual(get_retry_after(TembaAPIError(requests.HTTPError(response=response))), 30)
+        del response.headers['Retry-After']
+        self.assertEqual(get_retry_after(TembaAPIError(requests.HTTPError(response=response))), 60)
+        response.status_code = 404
+        self.assertIsNone(get_retry_after(TembaAPIError(requests.HTTPError(response=response))))
+        self.assertIsNone(get_retry_after(ValueError()))
+
+    def test_temba_client_pool(self):
+        pool = TembaClientPool(max_size=2, max_idle=300)
+        client = pool.get('http://localhost/api/v1', 'token1')
+        self.assertIs(pool.get('http://localhost/api/v1', 'token1'), client)
+        pool.get('http://localhost/api/v1', 'token2')
+        pool.get('http://localhost/api/v1', 'token3')
+        self.assertIsNot(pool.get('http://localhost/api/v1', 'token1'), client)
+        pool.max_idle = -1
+        self.assertIsNot(pool.get('http://localhost/api/v1', 'token3'), pool.get('http://localhost/api/v1', 'token3'))
+
+    def test_sync_run_telemetry(self):
+        run = SyncRun.objects.create(started_on=datetime.utcnow(), entities=['Group'])
+        step = SyncStep(run=run.id, org=dict(id=self.org.id, name=self.org.name), entity='Group',
+                        started_on=datetime.utcnow())
+        for seconds in (0.1, 0.2, 0.3, 0.4, 2.0):
+            step.record_fetch(seconds)
+        step.record_page(dict(inserted=3, updated=1, unchanged=2, write_time=0.5))
+        step.record_page(dict(inserted=1, updated=0, unchanged=0, write_time=0.25))
+        step.finish('completed')
+        step = SyncStep.objects.get(id=step.id)
+        self.assertEqual((step.pages, step.inserted, step.updated, step.skipped), (2, 4, 1, 2))
+        self.assertEqual(step.mongo_write_time, 0.75)
+        self.assertEqual(step.temba_latency['p50'], 300)
+        self.assertEqual(step.temba_latency['p99'], 2000)
+        run.finish()
+        self.assertEqual((run.status, run.step_count, run.pages), ('completed', 1, 2))
+
+    def test_plan_sync(self):
+        levels = plan_sync([dict(name='Run'), dict(name='Contact'), dict(name='Group'), dict(name='Flow')])
+        self.assertEqual([[e['name'] for e in level] for level in levels], [['Group', 'Flow'], ['Contact'], ['Run']])
+        levels = plan_sync([dict(name=cls.__name__) for cls in models.BaseUtil.__subclasses__()])
+        synced = []
+        for level in levels:
+            for entity in level:
+                self.assertTrue(models.BaseUtil.get_entity(entity['name']).get_dependencies().issubset(synced))
+            synced.extend(entity['name'] for entity in level)
+        self.assertEqual(len(synced), len(models.BaseUtil.__subclasses__()))
+
+    def test_import_csv_rows(self):
+        export = StringIO('id,broadcast,contact,labels,text,created_on\n'
+                          '12,,abc-123,"[""flagged""]",256700000001,2016-01-05T10:00:00.000Z\n')
+        row = list(ImportCommand().read_csv(export, types.Message))[0]
+        self.assertEqual(row['id'], 12)
+        self.assertIsNone(row['broadcast'])
+        self.assertEqual(row['labels'], ['flagged'])
+        self.assertEqual(row['text'], '256700000001')
+
+        # a short row leaves the cells it lacks empty, a long one drops the cells past the header
+        export = StringIO('id,broadcast,contact,text\n13,,abc-123\n14,,abc-123,hi,extra\n')
+        rows = list(ImportCommand().read_csv(export, types.Message))
+        self.assertEqual((rows[0]['id'], rows[0]['text']), (13, None))
+        self.assertEqual(sorted(rows[1].keys()), ['broadcast', 'contact', 'id', 'text'])
+
+    def test_import_keeps_unique_indexes(self):
+        collection = Run._get_collection()
+        Run.ensure_indexes()
+        command = ImportCommand(stdout=StringIO())
+        dropped = command.drop_indexes(collection)
+        try:
+            self.assertFalse([name for name, info in dropped.items() if info.get('unique')])
+            unique = [[field for field, direction in info['key']] for info in collection.index_information().values()
+                      if info.get('unique')]
+            self.assertIn(['org.id', 'tid'], unique)
+        finally:
+            command.restore_indexes(Run, collection, dropped)
+
+    def test_import_resolves_references_locally(self):
+        Contact.objects.filter(uuid='import-contact').delete()
+        with reference_cache(fetch=False):
+            Run.prefetch_references(self.org, [FakeTemba(contact='import-contact')])
+            self.assertEqual(Contact.get_reference(self.org, 'import-contact'), {})
+            self.assertIsNone(Contact.get_or_fetch(self.org, 'other-contact'))
+
+    def test_fake_rapidpro_paging(self):
+        data = FakeData(size=600)
+        count, runs = data.page('runs', {}, 2, 250)
+        self.assertEqual((count, len(runs), runs[0]['run']), (600, 250, 251))
+        count, runs = data.page('runs', {'after': ['2015-01-01T05:00:00.000000']}, 1, 250)
+        self.assertEqual((count, runs[0]['run']), (299, 302))
+        count, contacts = data.page('contacts', {'uuid': [runs[0]['contact']]}, 1, 250)
+        self.assertEqual(contacts[0]['uuid'], runs[0]['contact'])
+        self.assertIsNone(data.page('unknown', {}, 1, 250))
+
+    def test_failed_page_backoff(self):
+        FailedPage.objects.filter(entity='Run', page=7).delete()
+        failed = FailedPage.record(self.org, 'Run', 7, datetime(2016, 1, 1), 'TembaAPIError: boom')
+        self.assertEqual(FailedPage.record(self.org, 'Run', 7, datetime(2016, 1, 1), 'again').id, failed.id)
+        waits = []
+        for attempt in range(settings.FAILED_PAGE_MAX_ATTEMPTS):
+            before = datetime.utcnow()
+            failed.retry_later('still failing')
+            waits.append((failed.next_attempt_on - before).total_seconds())
+        self.assertTrue(waits[0] < waits[1] <= settings.FAILED_PAGE_RETRY_MAX + 1)
+        self.assertEqual(failed.status, 'abandoned')
+        self.assertNotIn(failed, FailedPage.get_due())
+        failed.delete()
+
+    def store_fake_references(self, data, contacts):
+        # the records FakeData references, so that resolving them does not call RapidPro
+        Contact.objects.filter(uuid__in=[data.contacts(i)['uuid'] for i in contacts]).delete()
+        Group.bulk_upsert_from_temba_list(self.org, [types.Group.deserialize(data.groups(0))])
+        Flow.bulk_upsert_from_temba_list(self.org, [types.Flow.deserialize(data.flows(0))])
+        Contact.bulk_upsert_from_temba_list(self.org, [types.Contact.deserialize(data.contacts(i)) for i in contacts])
+
+    def test_conversion_plan(self):
+        data = FakeData(size=10)
+        self.store_fake_references(data, [3])
+        for model, temba_type, endpoint in ((Run, types.Run, 'runs'), (Message, types.Message, 'messages'),
+                                            (Contact, types.Contact, 'contacts'), (Flow, types.Flow, 'flows')):
+            temba = temba_type.deserialize(getattr(data, endpoint)(3))
+            self.assertEqual(model.build_from_temba(self.org, temba).to_mongo(),
+                             build_reflective(model, self.org, temba).to_mongo())
+
+    def test_bulk_upsert_consumes_batches(self):
+        temba_list = [FakeTemba(uuid='batch-group-%d' % i, name='batch_group_%d' % i, size=i) for i in range(250)]
+        Group.objects.filter(uuid__startswith='batch-group-').delete()
+        writes = []
+
+        def bulk_write_docs(cls, org_query, batch, update, stats):
+            # the records not converted yet when each batch is written
+            writes.append((len(batch), len(temba_list)))
+            return models.BaseUtil.bulk_write_docs.__func__(cls, org_query, batch, update, stats)
+
+        Group.bulk_write_docs = classmethod(bulk_write_docs)
+        try:
+            stats = Group.bulk_upsert_from_temba_list(self.org, temba_list, batch_size=100)
+        finally:
+            del Group.bulk_write_docs
+        self.assertEqual(writes, [(100, 150), (100, 50), (50, 0)])
+        self.assertEqual(stats['inserted'], 250)
+        Group.objects.filter(uuid__startswith='batch-group-').delete()
+
+    def test_lease(self):
+        lease, other = Lease('test-lease', 5), Lease('test-lease', 5)
+        self.assertTrue(lease.acquire())
+        self.assertFalse(other.acquire())
+        other.token = 'stolen'
+        other.release()
+        self.assertTrue(lease.extend())
+        lease.release()
+        self.assertFalse(lease.extend())
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_semaphore_refresh(self):
+        semaphore = Semaphore('test-semaphore', 1, 60)
+        get_redis().delete(semaphore.key)
+        token = semaphore.acquire()
+        self.assertIsNotNone(token)
+        self.assertIsNone(semaphore.acquire())
+
+        # a refreshed slot is not reclaimed however old it was
+        get_redis().zadd(semaphore.key, time.time() - 120, token)
+        self.assertTrue(semaphore.refresh(token))
+        self.assertIsNone(semaphore.acquire())
+
+        # the lease keeps its slots refreshed
+        get_redis().zadd(semaphore.key, time.time() - 50, token)
+        lease = Lease('test-semaphore', 0.3)
+        self.assertTrue(lease.acquire())
+        with lease.kept_alive((semaphore, token)):
+            time.sleep(0.3)
+        self.assertGreater(get_redis().zscore(semaphore.key, token), time.time() - 5)
+
+        # a slot that was reclaimed is not taken back
+        get_redis().zadd(semaphore.key, time.time() - 120, token)
+        other = semaphore.acquire()
+        self.assertIsNotNone(other)
+        self.assertFalse(semaphore.refresh(token))
+        self.assertIsNone(get_redis().zscore(semaphore.key, token))
+        semaphore.release(other)
+
+    def test_bulk_upsert_is_scoped_to_org(self):
+        other_org = Org.objects.create(name='other', api_token='other-token')
+        temba_groups = [FakeTemba(uuid='scoped-group', name='scoped_group', size=1)]
+        Group.objects.filter(uuid='scoped-group').delete()
+        self.assertEqual(Group.bulk_upsert_from_temba_list(self.org, list(temba_groups))['inserted'], 1)
+        self.assertEqual(Group.bulk_upsert_from_temba_list(other_org, list(temba_groups))['inserted'], 1)
+        self.assertEqual(Group.bulk_upsert_from_temba_list(other_org, list(temba_groups))['unchanged'], 1)
+        self.assertEqual(Group.objects.filter(uuid='scoped-group').count(), 2)
+        stored = Group._get_collection().find_one({'uuid': 'scoped-group', 'org.id': other_org.id})
+        self.assertEqual(stored['org'], {'id': other_org.id})
+        Group.objects.filter(uuid='scoped-group').delete()
+        other_org.delete()
+
+    def test_parse_webhook_event(self):
+        steps = [{'node': 'node-1', 'arrived_on': '2016-01-01T10:00:00.000Z', 'left_on': None, 'text': 'Hi',
+                  'type': 'A', 'value': None}]
+        events = parse_event({'run': '12', 'flow_uuid': 'flow-1', 'contact': 'contact-1', 'contact_name': 'Jo',
+                              'urn': 'tel:+256700000001', 'steps': json.dumps(steps), 'values': '[]',
+                              'time': '2016-01-01T10:00:01.000Z'})
+        self.assertEqual([entity for entity, item in events], ['Contact', 'Run'])
+        self.assertIsNone(types.Contact.deserialize(events[0][1]).modified_on)
+        run = types.Run.deserialize(events[1][1])
+        self.assertEqual((run.id, run.flow, run.contact), (12, 'flow-1', 'contact-1'))
+        self.assertEqual(run.created_on, datetime(2016, 1, 1, 10, 0, tzinfo=pytz.utc))
+        events = parse_event({'sms': '7', 'contact': 'contact-1', 'text': 'yes', 'direction': 'I', 'status': 'H',
+                              'time': '2016-01-01T10:00:01.000Z'})
+        self.assertEqual(types.Message.deserialize(events[1][1]).id, 7)
+        self.assertRaises(WebhookError, parse_event, {'run': 'x', 'flow_uuid': 'flow-1'})
+        self.assertRaises(WebhookError, parse_event, {'event': 'unknown'})
+        self.assertRaises(WebhookError, parse_event, {'run': '1', 'flow_uuid': 'flow-1', 'steps': '["node-1"]'})
+        self.assertRaises(WebhookError, parse_event, {'run': '1', 'flow_uuid': 'flow-1', 'values': {'a': 1}})
+        self.assertRaises(WebhookError, parse_event, {'sms': '7', 'time': 'yesterday'})
+        self.assertRaises(WebhookError, parse_event, ['run', 'sms'])
+
+    def test_compact_org_references(self):
+        Group.build_from_temba(self.org, FakeTemba(uuid='compact-group', name='compact_group', size=1)).save()
+        stored = Group._get_collection().find_one({'uuid': 'compact-group'})
+        self.assertEqual(stored['org'], {'id': self.org.id})
+        Group._get_collection().update({'_id': stored['_id']}, {'$set': {'org': dict(
+            id=self.org.id, name=self.org.name, timezone=self.org.timezone, api_token=self.org.api_token)}})
+        self.assertEqual(Group.get_for_org(self.org.id).filter(uuid='compact-group').count(), 1)
+        self.assertEqual(Group.compact_org_references(), 1)
+        self.assertEqual(Group._get_collection().find_one({'uuid': 'compact-group'})['org'], {'id': self.org.id})
+
+        # a record stored again by a sync that ran before the migration keeps only the copy the sync stored
+        synced = Group._get_collection().find_one({'uuid': 'compact-group'})
+        legacy = dict(synced, _id=ObjectId(), org={'_cls': 'Org', '_ref': DBRef('org', self.org.id)})
+        Group._get_collection().insert(legacy)
+        self.assertEqual(Group.compact_org_references(), 1)
+        self.assertEqual([doc['_id'] for doc in Group._get_collection().find({'uuid': 'compact-group'})],
+                         [synced['_id']])
+        Group.objects.filter(uuid='compact-group').delete()
+
+    def test_compact_run(self):
+        steps = [FlowStep(node='node-%d' % i, text='step %d' % i, type='A', arrived_on=datetime(2016, 1, 1, 10, i),
+                          left_on=None) for i in range(3)]
+        values = [RunValueSet(node='node-2', category={'base': 'Yes'}, text='yes', rule_value='yes', label='Answer',
+                              value='Yes', time=datetime(2016, 1, 1, 10, 3))]
+        run = Run(org=self.org.as_reference(), flow={'id': ObjectId()}, tid=-1, created_on=datetime(2016, 1, 1, 10),
+                  steps=steps, values=values)
+        doc = run.to_mongo().to_dict()
+        packed = Run._from_son(dict(doc, steps=[], values=[], packed=Run.pack(doc))).unpack()
+        self.assertEqual([step.to_mongo() for step in packed.steps], [step.to_mongo() for step in steps])
+        self.assertEqual([value.to_mongo() for value in packed.values], [value.to_mongo() for value in values])
+        self.assertEqual(RunReadSerializer(packed).data['steps'], RunReadSerializer(run).data['steps'])
+
+    def test_pack_columns_keeps_milliseconds(self):
+        base = datetime(2015, 1, 16, 13, 14, 2, 441000)
+        items = [dict(arrived_on=datetime(2015, 4, 24, 15, 12, 59, 811000)), dict(arrived_on=None),
+                 dict(arrived_on=base + timedelta(days=400, milliseconds=1))]
+        packed = models._pack_columns(items, ('arrived_on',), base)
+        self.assertEqual(packed['arrived_on'][0], 8474337370)
+        self.assertEqual(models._unpack_columns(packed, ('arrived_on',), base), items)
+
+    def test_declared_indexes(self):
+        specs = [spec['fields'] for spec in Run._meta['index_specs']]
+        self.assertIn([('org.id', 1), ('created_on', 1), ('_id', 1)], specs)
+        self.assertIn([('flow.id', 1), ('created_on', 1), ('_id', 1)], specs)
+        for entity in (Group, Contact, Broadcast, Campaign, Label, Flow, Event, Message, Run):
+            unique = [spec['fields'] for spec in entity._meta['index_specs'] if spec.get('unique')]
+            self.assertEqual(unique, [[('org.id', 1), ('uuid' if 'uuid' in entity._fields else 'tid', 1)]])
+
+    def test_cursor_pagination(self):
+        org_id = ObjectId()
+        for i in range(5):
+            Group(org={'id': org_id}, uuid='cursor-%s' % i, created_on=datetime(2016, 1, 1 + i // 2)).save()
+        Group(org={'id': org_id}, uuid='cursor-none').save()
+        paginator = CursorPaginator(Group.get_for_org(org_id), 2)
+        pages, token = [], None
+        while True:
+            page = paginator.get_page(token)
+            pages.append([group.uuid for group in page.items])
+            if not page.next:
+                break
+            token = page.next
+        self.assertEqual(pages, [['cursor-4', 'cursor-3'], ['cursor-2', 'cursor-1'], ['cursor-0', 'cursor-none']])
+        previous = paginator.get_page(paginator.get_page(page.previous).previous)
+        self.assertEqual([group.uuid for group in previous.items], ['cursor-4', 'cursor-3'])
+        self.assertIsNone(previous.previous)
+        self.assertRaises(ValueError, paginator.get_page, 'not-a-cursor')
+        Group.get_for_org(org_id).delete()
+
+    def test_count_strategies(self):
+        org_id = ObjectId()
+        for i in range(5):
+            Group(org={'id': org_id}, uuid='count-%s' % i).save()
+        groups = Group.get_for_org(org_id)
+        self.assertEqual(CountPaginator(groups, 2).count, 5)
+        uncounted = CountPaginator(groups, 2, strategy='none')
+        self.assertIsNone(uncounted.count)
+        self.assertTrue(uncounted.page(2).has_next())
+        self.assertFalse(uncounted.page(3).has_next())
+        self.assertEqual(len(uncounted.page(3)), 1)
+        self.assertRaises(EmptyPage, uncounted.page, 4)
+        self.assertEqual(CountPaginator(groups, 2, strategy='estimated').count, 5)
+        groups.delete()
+
+    def test_sparse_fields(self):
+        self.assertEqual(RunReadSerializer.get_model_fields(['id', 'completed', 'flow_id']),
+                         set(['id', 'completed', 'flow']))
+        self.assertEqual(RunReadSerializer.get_model_fields(['steps']), set(['steps', 'packed', 'flow']))
+        run = Run(org=self.org.as_reference(), flow={'id': ObjectId()}, contact={}, tid=-1, completed='True',
+                  created_on=datetime(2016, 1, 1))
+        data = RunReadSerializer(run, context={'fields': set(['completed', 'flow_id'])}).data
+        self.assertEqual(sorted(data.keys()), ['completed', 'flow_id'])
+        data = RunReadSerializer(run, context={'exclude': set(['steps', 'values'])}).data
+        self.assertNotIn('steps', data)
+        self.assertIn('contact_id', data)
+
+    def test_prefetch_references(self):
+        data = FakeData(size=10)
+        self.store_fake_references(data, range(10))
+        runs = [types.Run.deserialize(data.runs(i)) for i in range(10)]
+        db = Run._get_db()
+
+        def queries():
+            return db.command('serverStatus')['opcounters']['query']
+
+        with reference_cache():
+            before = queries()
+            Run.prefetch_references(self.org, runs)
+            # one query for the contacts and one for the flow of the whole page
+            self.assertEqual(queries() - before, 2)
+            before = queries()
+            docs = [Run.build_from_temba(self.org, run).to_mongo() for run in runs]
+            self.assertEqual(queries() - before, 0)
+        flow = Flow.get_for_org(self.org.id).get(uuid=data.flows(0)['uuid'])
+        contact = Contact.get_for_org(self.org.id).get(uuid=data.contacts(3)['uuid'])
+        self.assertEqual(docs[3]['flow'], {'id': flow.id})
+        self.assertEqual(docs[3]['contact'], {'id': contact.id})
+        self.assertEqual(Contact.get_for_org(self.org.id).get(uuid=data.contacts(3)['uuid']).groups,
+                         [Group.get_for_org(self.org.id).get(uuid=data.groups(0)['uuid']).as_reference()])
+
+    def test_webhook_buffer(self):
+        buffer = WebhookBuffer()
+        get_redis().delete(buffer.key, buffer.flush_key)
+        self.assertEqual(buffer.push('org-1', [('Contact', {'uuid': 'a'}), ('Run', {'run': 1})]), 2)
+        self.assertEqual(buffer.push('org-2', [('Message', {'id': 3})]), 3)
+        self.assertEqual(buffer.pop(2), [['org-1', 'Contact', {'uuid': 'a'}], ['org-1', 'Run', {'run': 1}]])
+        self.assertEqual(buffer.requeue([['org-1', 'Run', {'run': 1}]], 2), 0)
+        self.assertEqual(buffer.pop(10), [['org-1', 'Run', {'run': 1}, 1], ['org-2', 'Message', {'id': 3}]])
+        self.assertEqual(buffer.pop(10), [])
+        # the second failure is the last
+        get_redis().delete(buffer.dead_key)
+        self.assertEqual(buffer.requeue([['org-1', 'Run', {'run': 1}, 1]], 2), 1)
+        self.assertEqual(buffer.pop(10), [])
+        self.assertEqual([json.loads(event) for event in get_redis().lrange(buffer.dead_key, 0, -1)],
+                         [['org-1', 'Run', {'run': 1}, 2]])
+        get_redis().delete(buffer.dead_key)
+        self.assertTrue(buffer.schedule_flush(60000))
+        self.assertFalse(buffer.schedule_flush(60000))
+        get_redis().delete(buffer.flush_key)
+
+    def test_webhook_view(self):
+        buffer = WebhookBuffer()
+        # a flush counts as scheduled already, so the events accepted stay in the buffer
+        get_redis().delete(buffer.key)
+        get_redis().set(buffer.flush_key, 1, px=60000)
+        org = Org.objects.create(name='webhooks', api_token='webhooks-token', webhook_secret='test-secret')
+        view, factory = WebhookEvents.as_view(), APIRequestFactory()
+        url = '/api/v1/webhooks/org/%s/' % org.id
+        event = {'sms': '7', 'contact': 'contact-1', 'text': 'yes', 'direction': 'I', 'status': 'H',
+                 'time': '2016-01-01T10:00:01.000Z'}
+
+        def post(path, data, **extra):
+            return view(factory.post(path, data, **extra), org=str(org.id))
+
+        self.assertEqual(post(url, event).status_code, 403)
+        self.assertEqual(post(url + '?secret=wrong', event).status_code, 403)
+        self.assertEqual(post(url, event, HTTP_X_WEBHOOK_SECRET='wrong').status_code, 403)
+        unknown = view(factory.post('/api/v1/webhooks/org/unknown/?secret=test-secret', event), org='unknown')
+        self.assertEqual(unknown.status_code, 403)
+        response = post(url + '?secret=test-secret', event)
+        self.assertEqual((response.status_code, response.data), (202, {'queued': 2}))
+        self.assertEqual(post(url, event, HTTP_X_WEBHOOK_SECRET='test-secret').status_code, 202)
+        self.assertEqual(post(url + '?secret=test-secret', {'event': 'unknown'}).status_code, 400)
+        self.assertEqual(post(url + '?secret=test-secret', dict(event, sms='x')).status_code, 400)
+        queued = buffer.pop(10)
+        self.assertEqual([entity for org_id, entity, item in queued], ['Contact', 'Message', 'Contact', 'Message'])
+        self.assertEqual(set(org_id for org_id, entity, item in queued), set([str(org.id)]))
+        get_redis().delete(buffer.flush_key)
+        org.delete()
+
+    def test_flush_webhooks(self):
+        buffer = WebhookBuffer()
+        get_redis().delete(buffer.key)
+        Contact.objects.filter(uuid='webhook-contact').delete()
+        Message.objects.filter(tid=990001).delete()
+        Run.objects.filter(tid=990002).delete()
+        Flow.objects.filter(uuid='webhook-flow').delete()
+        flow = Flow(org=self.org.as_reference(), uuid='webhook-flow', name='webhook_flow')
+        flow.save()
+        steps = [{'node': 'node-1', 'arrived_on': '2016-01-01T10:00:00.000Z', 'left_on': None, 'text': 'Hi',
+                  'type': 'A', 'value': None}]
+        run_event = {'run': '990002', 'flow_uuid': 'webhook-flow', 'contact': 'webhook-contact', 'contact_name': 'Jo',
+                     'steps': json.dumps(steps), 'values': '[]', 'time': '2016-01-01T10:00:01.000Z'}
+        sms_event = {'sms': '990001', 'contact': 'webhook-contact', 'contact_name': 'Jo', 'text': 'yes',
+                     'direction': 'I', 'status': 'H', 'time': '2016-01-01T10:00:01.000Z'}
+        buffer.push(str(self.org.id), parse_event(sms_event) + parse_event(run_event))
+        flush_webhooks()
+        self.assertEqual(buffer.pop(10), [])
+        contact = Contact.get_for_org(self.org.id).get(uuid='webhook-contact')
+        self.assertIsNone(contact.modified_on)
+        self.assertEqual(Message.get_for_org(self.org.id).get(tid=990001).contact, contact.as_reference())
+        run = Run.get_for_org(self.org.id).get(tid=990002)
+        self.assertEqual((run.flow, run.contact), (flow.as_reference(), contact.as_reference()))
+        self.assertEqual([step.node for step in run.steps], ['node-1'])
+
+        # a later event of the same run brings its new steps
+        steps.append(dict(steps[0], node='node-2', arrived_on='2016-01-01T10:05:00.000Z'))
+        buffer.push(str(self.org.id), parse_event(dict(run_event, steps=json.dumps(steps))))
+        flush_webhooks()
+        run = Run.get_for_org(self.org.id).get(tid=990002)
+        self.assertEqual([step.node for step in run.steps], ['node-1', 'node-2'])
+        self.assertEqual(Contact.get_for_org(self.org.id).filter(uuid='webhook-contact').count(), 1)
+
+        # an event that cannot be written goes back to the buffer without holding up the rest of its batch, and to
+        # the dead letter list once it failed WEBHOOK_MAX_ATTEMPTS times. The retry counts as scheduled already
+        get_redis().delete(buffer.dead_key)
+        get_redis().set(buffer.flush_key, 1)
+        bad_event = [str(self.org.id), 'Flow', {'uuid': 'webhook-flow'}]
+        buffer.push(str(self.org.id), [('Flow', {'uuid': 'webhook-flow'})] +
+                    parse_event(dict(sms_event, sms='990003')))
+        flush_webhooks()
+        self.assertEqual(Message.get_for_org(self.org.id).filter(tid=990003).count(), 1)
+        self.assertEqual([json.loads(event) for event in get_redis().lrange(buffer.key, 0, -1)], [bad_event + [1]])
+        for attempt in range(1, settings.WEBHOOK_MAX_ATTEMPTS):
+            flush_webhooks()
+        self.assertEqual(buffer.pop(10), [])
+        self.assertEqual([json.loads(event) for event in get_redis().lrange(buffer.dead_key, 0, -1)],
+                         [bad_event + [settings.WEBHOOK_MAX_ATTEMPTS]])
+        get_redis().delete(buffer.dead_key, buffer.flush_key)
+        Contact.objects.filter(uuid='webhook-contact').delete()
+        Message.objects.filter(tid__in=[990001, 990003]).delete()
+        Run.objects.filter(tid=990002).delete()
+        flow.delete()
+
+    def run_pipelined(self, fetch_page, ingest_page, depth=2):
+        """
+        Runs fetch_pages_pipelined over fake fetch_page and ingest_page. Pages set aside re-raise their error, as
+        set_aside_page does once too many pages failed.
+        """
+        def set_aside_page(entity, org, n, cursor, step, exc_info):
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        originals = tasks.fetch_page, tasks.ingest_page, tasks.set_aside_page
+        tasks.fetch_page, tasks.ingest_page, tasks.set_aside_page = fetch_page, ingest_page, set_aside_page
+        try:
+            tasks.fetch_pages_pipelined(dict(name=Group), self.org, 1, None, None, depth)
+        finally:
+            tasks.fetch_page, tasks.ingest_page, tasks.set_aside_page = originals
+
+    def test_pipelined_pages_are_ingested_in_order(self):
+        ingested = []
+
+        def fetch_page(entity, org, n, cursor, step):
+            time.sleep(0.01 * (n % 3))
+            return [n], n < 6
+
+        def ingest_page(entity, org, n, temba_list, cursor, step):
+            ingested.append((n, temba_list))
+
+        self.run_pipelined(fetch_page, ingest_page)
+        self.assertEqual(ingested, [(n, [n]) for n in range(1, 7)])
+
+    def test_pipelined_fetch_error_reaches_caller(self):
+        ingested = []
+
+        def fetch_page(entity, org, n, cursor, step):
+            if n == 2:
+                raise ValueError("page 2 is broken")
+            return [n], True
+
+        with self.assertRaisesRegexp(ValueError, "page 2 is broken"):
+            self.run_pipelined(fetch_page, lambda entity, org, n, temba_list, cursor, step: ingested.append(n))
+        self.assertEqual(ingested, [1])
+
+    def test_pipelined_fetch_waits_for_ingestion(self):
+        fetched, threads, errors = [], [], []
+        ingesting, resume = threading.Event(), threading.Event()
+
+        def fetch_page(entity, org, n, cursor, step):
+            threads.append(threading.current_thread())
+            fetched.append(n)
+            return [n], True
+
+        def ingest_page(entity, org, n, temba_list, cursor, step):
+            ingesting.set()
+            resume.wait(5)
+            raise ValueError("cannot write page %s" % n)
+
+        def run():
+            try:
+                self.run_pipelined(fetch_page, ingest_page, depth=2)
+            except ValueError as e:
+                errors.append(str(e))
+
+        runner = threading.Thread(target=run)
+        runner.start()
+        ingesting.wait(5)
+        time.sleep(0.5)
+        # page 1 is being written, pages 2 and 3 wait in the queue and page 4 waits for room
+        self.assertEqual(fetched, [1, 2, 3, 4])
+        resume.set()
+        runner.join(5)
+        self.assertEqual(errors, ["cannot write page 1"])
+
+        # the failed write stops the fetcher instead of leaving it to fetch the rest of the pages
+        threads[0].join(5)
+        self.assertFalse(threads[0].is_alive())
+        self.assertEqual(fetched, [1, 2, 3, 4])
+
+    def test_ensure_indexes_report(self):
+        FailedPage.ensure_indexes()
+        FailedPage._get_db()[FailedPage._get_collection_name()].drop_index('status_1_next_attempt_on_1')
+        # as in a new process, where the first _get_collection() builds the indexes
+        FailedPage._collection = None
+        output = StringIO()
+        call_command('ensure_indexes', report=True, stdout=output)
+        self.assertRegexpMatches(output.getvalue(),
+                                 r'FailedPage \(failed_pages\)\n  missing: +status 1, next_attempt_on 1\n')
+        self.assertNotIn('status_1_next_attempt_on_1', FailedPage._get_db()['failed_pages'].index_information())
+        call_command('ensure_indexes', stdout=StringIO())
+        self.assertIn('status_1_next_attempt_on_1', FailedPage._get_db()['failed_pages'].index_information())
+
+    def test_failed_org_entity_finishes_its_step(self):
+        run = SyncRun(started_on=datetime.utcnow(), entities=['Run'], pending_orgs=1)
+        run.save()
+        missing_org = str(ObjectId())
+        result = fetch_org_entity(missing_org, {'name': 'Run'}, str(run.id))
+        self.assertEqual(result, dict(org=missing_org, entity='Run', pages=0, status='failed'))
+        step = run.get_steps().get()
+        self.assertEqual((step.status, step.org, step.errors), ('failed', {'id': ObjectId(missing_org)}, 1))
+        step.delete()
+        run.delete()
+
+    def test_contact_groups_are_named_by_id(self):
+        group = Group.objects.create(org=self.org.as_reference(), uuid='g-1', name='Testers')
+        contact = Contact.objects.create(org=self.org.as_reference(), uuid='c-1', name='Tester', fields={},
+                                         groups=[group.as_reference()])
+        self.assertEqual(contact.reload().groups, [{'id': group.id}])
+        context = {'fields': set(['groups'])}
+        self.assertEqual(ContactReadSerializer(contact, context=context).data['groups'], ['Testers'])
+        group.update(set__name='Renamed')
+        # names are looked up once per request
+        self.assertEqual(ContactReadSerializer(contact, context=context).data['groups'], ['Testers'])
+        self.assertEqual(ContactReadSerializer(contact, context={'fields': set(['groups'])}).data['groups'],
+                         ['Renamed'])
+        contact.delete()
+        group.delete()
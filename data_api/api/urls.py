@@ -1,7 +1,7 @@
 from django.conf.urls import patterns, url
 from data_api.api.views import RunList, RunDetails, ContactDetails, ContactList, FlowList, FlowDetails, OrgDetails, \
     OrgList, MessageList, MessageDetails, BroadcastList, BroadcastDetails, CampaignDetails, CampaignList, EventList, \
-    EventDetails
+    EventDetails, SyncRunList, SyncRunDetails, WebhookEvents
 
 __author__ = 'kenneth'
 
@@ -40,4 +40,9 @@ urlpatterns = patterns('',
                        url(r'^runs/flow/(?P<flow>[\w]+)/$', RunList.as_view()),
                        url(r'^runs/flow_uuid/(?P<flow_uuid>[\w\-]+)/$', RunList.as_view()),
                        url(r'^runs/(?P<id>[\w]+)/$', RunDetails.as_view()),
+
+                       url(r'^syncs/$', SyncRunList.as_view()),
+                       url(r'^syncs/(?P<id>[\w]+)/$', SyncRunDetails.as_view()),
+
+                       url(r'^webhooks/org/(?P<org>[\w]+)/$', WebhookEvents.as_view()),
                        )
@@ -1,9 +1,94 @@
+from collections import OrderedDict
 from datetime import datetime
+import threading
+from django.conf import settings
+import pytz
+import redis
 
 __author__ = 'kenneth'
 
+_redis = None
+
 
 def get_date_from_param(param):
     if len(param) != 8:
         raise RuntimeError("Wrong date format. Use: ddmmyyyy")
-    return datetime(int(param[4:8]), int(param[2:4]), int(param[:2]))
\ No newline at end of file
+    return datetime(int(param[4:8]), int(param[2:4]), int(param[:2]))
+
+
+def as_utc(value):
+    """
+    Returns value as an aware UTC datetime, naive values (as read back from Mongo) are taken to be UTC already.
+    """
+    if value is None or value.tzinfo is None:
+        return value and pytz.utc.localize(value)
+    return value.astimezone(pytz.utc)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def drain(items):
+    """
+    Yields the items of a list while emptying it, so that each item can be freed as soon as it has been consumed.
+    """
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _redis
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe mapping that evicts the least recently used key once max_size is reached and counts
+    hits and misses.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses)
@@ -1,18 +1,53 @@
+from collections import OrderedDict
+from functools import partial
+import hashlib
 from bson import ObjectId
 from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from mongoengine.django.shortcuts import get_document_or_404
+from rest_framework import status
+from rest_framework.exceptions import ParseError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.templatetags.rest_framework import replace_query_param
+from rest_framework.views import APIView
 from rest_framework_mongoengine.generics import ListAPIView, RetrieveAPIView
-from data_api.api.models import Run, Contact, Flow, Org, Message, Broadcast, Campaign, Event
-from data_api.api.permissions import ContactAccessPermissions, MessageAccessPermissions, OrgAccessPermissions
+from data_api.api.models import Run, Contact, Flow, Org, Message, Broadcast, Campaign, Event, SyncRun
+from data_api.api.pagination import COUNT_STRATEGIES, CountPaginator, CursorPaginator, get_count_generation
+from data_api.api.permissions import ContactAccessPermissions, MessageAccessPermissions, OrgAccessPermissions, \
+    SyncAccessPermissions
 from data_api.api.serializers import RunReadSerializer, ContactReadSerializer, FlowReadSerializer, OrgReadSerializer, \
-    MessageReadSerializer, BroadcastReadSerializer, CampaignReadSerializer, EventReadSerializer
+    MessageReadSerializer, BroadcastReadSerializer, CampaignReadSerializer, EventReadSerializer, SyncRunReadSerializer
+from data_api.api.tasks import queue_webhook_events
 from data_api.api.utils import get_date_from_param
+from data_api.api.webhooks import WebhookError, parse_event
 
 __author__ = 'kenneth'
 
 
 class DataListAPIView(ListAPIView):
+    """
+    Lists documents of an org by page number, or by position with ?cursor=, which costs the same however deep the
+    page is and is followed through the next and previous links. ?count= picks how the count is found, see
+    CountPaginator, and ?fields= or ?exclude= narrow the serializer fields as well as what is read from Mongo.
+    """
+    count_strategy = None
+
+    @property
+    def paginator_class(self):
+        strategy = self.request.query_params.get('count') or self.count_strategy or settings.LIST_COUNT_STRATEGY
+        if strategy not in COUNT_STRATEGIES:
+            raise ParseError("count must be one of %s" % ", ".join(COUNT_STRATEGIES))
+        cache_key = self.get_count_cache_key() if strategy == 'cached' else None
+        return partial(CountPaginator, strategy=strategy, cache_key=cache_key)
+
+    def get_count_cache_key(self):
+        entity, org = self.object_model.__name__, self.kwargs.get('org')
+        params = sorted((key, values) for key, values in self.request.query_params.lists()
+                        if key not in ('page', 'page_size', 'count', 'format', 'fields', 'exclude'))
+        filters = hashlib.md5(repr((sorted(self.kwargs.items()), params))).hexdigest()
+        return 'count:%s:%s:%s:%s' % (entity, org, get_count_generation(entity, org), filters)
+
     def get_queryset(self):
         if not self.kwargs.get('org'):
             return self.object_model.objects.none()
@@ -26,8 +61,60 @@ class DataListAPIView(ListAPIView):
             q = q.filter(created_on__gt=get_date_from_param(self.request.query_params.get('after')))
         if self.request.query_params.get('before', None):
             q = q.filter(created_on__lt=get_date_from_param(self.request.query_params.get('before')))
+        return self.project(q)
+
+    def get_sparse_fields(self):
+        """
+        Returns the serializer fields asked for with ?fields= and left out with ?exclude=, both comma separated.
+        """
+        available = self.get_serializer_class()().fields.keys()
+        sparse = []
+        for param in ('fields', 'exclude'):
+            names = set(name.strip() for name in self.request.query_params.get(param, '').split(',') if name.strip())
+            unknown = names.difference(available)
+            if unknown:
+                raise ParseError("Unknown fields %s, the fields are %s" % (", ".join(sorted(unknown)),
+                                                                           ", ".join(available)))
+            sparse.append(names)
+        return available, sparse[0], sparse[1]
+
+    def project(self, q):
+        """
+        Reads only the document fields the requested serializer fields need. id and created_on are always read, cursor
+        pagination orders by them.
+        """
+        available, fields, exclude = self.get_sparse_fields()
+        serializer_class = self.get_serializer_class()
+        always = set(['id', 'created_on'])
+        if fields:
+            q = q.only(*serializer_class.get_model_fields(fields.difference(exclude)).union(always))
+        elif exclude:
+            kept = serializer_class.get_model_fields(set(available).difference(exclude)).union(always)
+            dropped = serializer_class.get_model_fields(exclude).difference(kept)
+            if dropped:
+                q = q.exclude(*dropped)
         return q
 
+    def get_serializer_context(self):
+        context = super(DataListAPIView, self).get_serializer_context()
+        available, context['fields'], context['exclude'] = self.get_sparse_fields()
+        return context
+
+    def list(self, request, *args, **kwargs):
+        if 'cursor' not in request.query_params:
+            return super(DataListAPIView, self).list(request, *args, **kwargs)
+        paginator = CursorPaginator(self.filter_queryset(self.get_queryset()), self.get_paginate_by())
+        try:
+            page = paginator.get_page(request.query_params['cursor'])
+        except ValueError as e:
+            raise ParseError(str(e))
+        url = request.build_absolute_uri()
+        return Response(OrderedDict([
+            ('next', page.next and replace_query_param(url, 'cursor', page.next)),
+            ('previous', page.previous and replace_query_param(url, 'cursor', page.previous)),
+            ('results', self.get_serializer(page.items, many=True).data),
+        ]))
+
 
 class RunList(DataListAPIView):
     """
@@ -38,6 +125,10 @@ class RunList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int)
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```id,flow_id,completed``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```steps,values``` (comma separated strings)
     * **before** - Return results with ```created_on``` date before (digit) (format ``ddmmyyyy``)
     * **after** - Return results with ```created_on``` date after (digit) (format ``ddmmyyyy``)
 
@@ -134,6 +225,10 @@ class ContactList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int)
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```id,groups``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```contact_fields``` (comma separated strings)
 
     ## Listing Contacts
 
@@ -199,6 +294,10 @@ class FlowList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int)
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```uuid,name,runs``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```rulesets``` (comma separated strings)
     * **before** - Return results with ```created_on``` date before (digit) (format ``ddmmyyyy``)
     * **after** - Return results with ```created_on``` date after (digit) (format ``ddmmyyyy``)
 
@@ -335,6 +434,10 @@ class MessageList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int)
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```contact,text,created_on``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```text``` (comma separated strings)
     * **before** - Return results with ```created_on``` date before (digit) (format ``ddmmyyyy``)
     * **after** - Return results with ```created_on``` date after (digit) (format ``ddmmyyyy``)
 
@@ -413,6 +516,10 @@ class BroadcastList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int)
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```text,status,created_on``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```contacts,groups``` (comma separated strings)
 
     ## Listing Broadcasts
     """
@@ -441,6 +548,10 @@ class CampaignList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int))
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```uuid,name,group``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```group``` (comma separated strings)
 
     ## Listing Campaigns
     """
@@ -469,6 +580,10 @@ class EventList(DataListAPIView):
     You can use the filters below in the url query string(```?filter=value```) to filter the data
 
     * **page_size** - Determine number of results per page. Maximum 1000, default 10 (int)
+    * **cursor** - Page most recent first by position instead of page number, empty for the first page (string)
+    * **count** - ```exact```, ```cached```, ```estimated``` or ```none```, default exact (string)
+    * **fields** - Return only these fields, e.g. ```uuid,flow,offset,unit``` (comma separated strings)
+    * **exclude** - Return all fields but these, e.g. ```message``` (comma separated strings)
 
     ## Listing Events
     """
@@ -493,3 +608,118 @@ class EventDetails(RetrieveAPIView):
     serializer_class = EventReadSerializer
     queryset = Event
 
+
+class SyncRunList(ListAPIView):
+    """
+    This endpoint allows you to list sync runs, the scheduled pulls of data from RapidPro.
+
+    ## Listing Sync Runs
+
+    By making a ```GET``` request you can list all the sync runs. Each sync run has the following attributes:
+
+    * **id** - the ID of the sync run (string)
+    * **started_on** - the TIME when this sync run was started (datetime)
+    * **finished_on** - the TIME when the last step of this sync run finished (datetime)
+    * **status** - the STATUS of this sync run: running, completed or failed (string)
+    * **entities** - the ENTITIES synced in this run (list(string))
+    * **step_count** - the number of org entities synced (int)
+    * **failed_count** - the number of org entities that failed (int)
+    * **pages** - the number of pages fetched from RapidPro (int)
+    * **steps** - one STEP per org and entity (list(dictionary)), with the pages fetched, records inserted, updated
+      and skipped, pages set aside for retry, RapidPro latency percentiles in milliseconds, Mongo write time in
+      seconds and errors
+
+    Examples:
+
+        GET /api/v1/syncs/
+
+    Response is the list of sync runs, most recent first:
+
+        {
+            "count": 12,
+            "next": "/api/v1/syncs/?page=1",
+            "previous": null,
+            "results": [
+            {
+                "id": "xxxxxxxxxxxxxxxxxxxxxxxxx",
+                "started_on": "2015-07-28T19:00:00.431000",
+                "finished_on": "2015-07-28T19:10:47.431000",
+                "status": "completed",
+                "entities": ["Contact", "Run"],
+                "step_count": 2,
+                "failed_count": 0,
+                "pages": 14,
+                "steps": [
+                    {
+                        "id": "xxxxxxxxxxxxxxxxxxxxxxxxx",
+                        "org_id": "xxxxxxxxxxxxxxxxxxxxxxxxx",
+                        "entity": "Contact",
+                        "status": "completed",
+                        "started_on": "2015-07-28T19:00:01.431000",
+                        "finished_on": "2015-07-28T19:04:12.431000",
+                        "pages": 6,
+                        "inserted": 1200,
+                        "updated": 35,
+                        "skipped": 4,
+                        "errors": 1,
+                        "failed_pages": 0,
+                        "temba_latency": {"p50": 420.5, "p90": 910.2, "p99": 2300.0},
+                        "mongo_write_time": 3.2
+                    },
+                    ...
+                ]
+            },
+            ...
+        }
+    """
+    serializer_class = SyncRunReadSerializer
+    queryset = SyncRun.objects.all()
+    permission_classes = (IsAuthenticated, SyncAccessPermissions)
+
+
+class SyncRunDetails(RetrieveAPIView):
+    """
+    This endpoint allows you to a single sync run.
+
+    Example:
+
+        GET /api/v1/syncs/xxxxxxxxxxxxx/
+    """
+    serializer_class = SyncRunReadSerializer
+    queryset = SyncRun.objects.all()
+    permission_classes = (IsAuthenticated, SyncAccessPermissions)
+
+
+class WebhookEvents(APIView):
+    """
+    This endpoint receives the flow and message webhook events of an org from RapidPro, so that new runs and
+    messages show up within seconds instead of after the next sync.
+
+    Set the webhook URL of the org, or of the flow's webhook action, to the URL below with the org's webhook secret.
+    Events are written in batches; contacts and messages that are already stored are left as they are, runs are
+    updated with the steps and values of the event.
+
+    Example:
+
+        POST /api/v1/webhooks/org/xxxxxxxxxxxxx/?secret=xxxxxxxxxxxxx
+
+    Response is the number of records queued:
+
+        {
+            "queued": 2
+        }
+    """
+    authentication_classes = ()
+    permission_classes = ()
+
+    def post(self, request, org):
+        org = Org.objects.filter(id=org).first() if ObjectId.is_valid(org) else None
+        secret = request.query_params.get('secret') or request.META.get('HTTP_X_WEBHOOK_SECRET', '')
+        if org is None or not org.webhook_secret or not constant_time_compare(org.webhook_secret, secret):
+            return Response({'detail': 'Unknown org or wrong secret'}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            events = parse_event(request.data)
+        except WebhookError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        queue_webhook_events(org, events)
+        return Response({'queued': len(events)}, status=status.HTTP_202_ACCEPTED)
@@ -0,0 +1,122 @@
+import json
+from temba import types
+from temba.base import TembaException
+from data_api.api.utils import get_redis
+
+__author__ = 'kenneth'
+
+
+class WebhookError(ValueError):
+    pass
+
+
+def _get_list(data, key):
+    value = data.get(key) or []
+    if isinstance(value, basestring):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise WebhookError("%s is not valid JSON" % key)
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise WebhookError("%s must be a list of objects" % key)
+    return value
+
+
+def _get_int(data, key):
+    try:
+        return int(data[key])
+    except (KeyError, TypeError, ValueError):
+        raise WebhookError("%s must be an integer" % key)
+
+
+def get_contact(data):
+    """
+    The contact of an event as returned by the contacts endpoint. Webhooks do not carry groups or fields, so it is
+    only good for creating contacts that are not stored yet. It has no modified_on, so that the next sync of contacts
+    does not take it as up to date and overwrites it.
+    """
+    return dict(uuid=data['contact'], name=data.get('contact_name'), urns=[data['urn']] if data.get('urn') else [],
+                group_uuids=[], fields={}, language=None, modified_on=None)
+
+
+def parse_flow_event(data):
+    steps = _get_list(data, 'steps')
+    if not data.get('flow_uuid'):
+        raise WebhookError("flow_uuid is required")
+    run = dict(run=_get_int(data, 'run'), flow_uuid=data['flow_uuid'], contact=data.get('contact'), steps=steps,
+               values=_get_list(data, 'values'), created_on=steps[0].get('arrived_on') if steps else data.get('time'),
+               expires_on=None, expired_on=None, completed=None)
+    return [('Contact', get_contact(data)), ('Run', run)] if data.get('contact') else [('Run', run)]
+
+
+def parse_message_event(data):
+    message = dict(id=_get_int(data, 'sms'), broadcast=None, contact=data.get('contact'), urn=data.get('urn'),
+                   status=data.get('status'), type=None, labels=[], direction=data.get('direction'), archived=False,
+                   text=data.get('text'), created_on=data.get('time'), delivered_on=None, sent_on=None)
+    return [('Contact', get_contact(data)), ('Message', message)] if data.get('contact') else [('Message', message)]
+
+
+def parse_event(data):
+    """
+    Turns a RapidPro flow or message webhook payload into (entity, object) pairs, each object in the format the
+    corresponding API endpoint returns so that it goes through the same conversion as a polled record.
+    """
+    if not hasattr(data, 'get'):
+        raise WebhookError("Not a flow or message event")
+    if 'run' in data:
+        events = parse_flow_event(data)
+    elif 'sms' in data:
+        events = parse_message_event(data)
+    else:
+        raise WebhookError("Not a flow or message event")
+    for entity, item in events:
+        try:
+            getattr(types, entity).deserialize(item)
+        except (TembaException, TypeError, ValueError) as e:
+            # ValueError and TypeError come from values of the wrong type, e.g. a time that is not a date
+            raise WebhookError(str(e))
+    return events
+
+
+class WebhookBuffer(object):
+    """
+    Webhook events waiting to be written, shared by all workers through a Redis list.
+    """
+    key = 'webhooks:events'
+    flush_key = 'webhooks:flush'
+    dead_key = 'webhooks:dead'
+
+    def push(self, org_id, events):
+        pipe = get_redis().pipeline()
+        for entity, item in events:
+            pipe.rpush(self.key, json.dumps([org_id, entity, item]))
+        return pipe.execute()[-1]
+
+    def pop(self, count):
+        pipe = get_redis().pipeline()
+        pipe.lrange(self.key, 0, count - 1)
+        pipe.ltrim(self.key, count, -1)
+        return [json.loads(event) for event in pipe.execute()[0]]
+
+    def requeue(self, events, max_attempts):
+        """
+        Puts events that could not be written back at the head of the buffer, counting their attempts, or on the dead
+        letter list once they failed max_attempts times. Returns how many went to the dead letter list.
+        """
+        pipe = get_redis().pipeline()
+        dead = 0
+        for event in reversed(events):
+            event = event[:3] + [(event[3] if len(event) > 3 else 0) + 1]
+            if event[3] >= max_attempts:
+                pipe.rpush(self.dead_key, json.dumps(event))
+                dead += 1
+            else:
+                pipe.lpush(self.key, json.dumps(event))
+        pipe.execute()
+        return dead
+
+    def schedule_flush(self, interval):
+        """
+        True for the first caller in every interval milliseconds, who should then schedule a flush.
+        """
+        return bool(get_redis().set(self.flush_key, 1, nx=True, px=interval))
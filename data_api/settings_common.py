@@ -14,6 +14,7 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 import datetime
+import json
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -107,16 +108,106 @@ REST_FRAMEWORK = {
 
 
 RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 10))
-RETRY_WAIT_FIXED = int(os.environ.get('RETRY_WAIT_FIXED', 15*60*1000))
+# Temba calls that fail are retried after 2^attempt * RETRY_WAIT_MULTIPLIER ms (at most RETRY_WAIT_MAX ms) plus up
+# to RETRY_WAIT_JITTER ms of random jitter
+RETRY_WAIT_MULTIPLIER = int(os.environ.get('RETRY_WAIT_MULTIPLIER', 1000))
+RETRY_WAIT_MAX = int(os.environ.get('RETRY_WAIT_MAX', 15*60*1000))
+RETRY_WAIT_JITTER = int(os.environ.get('RETRY_WAIT_JITTER', 1000))
+
+# Requests per second allowed per API token across all workers, the burst size, and the seconds to back off when
+# Temba throttles without sending Retry-After
+TEMBA_RATE_LIMIT = float(os.environ.get('TEMBA_RATE_LIMIT', 1))
+TEMBA_RATE_BURST = int(os.environ.get('TEMBA_RATE_BURST', 10))
+TEMBA_THROTTLE_BACKOFF = int(os.environ.get('TEMBA_THROTTLE_BACKOFF', 60))
+
+# Temba clients kept alive per process, seconds an unused one is kept, and keep-alive connections per client
+TEMBA_CLIENT_POOL_SIZE = int(os.environ.get('TEMBA_CLIENT_POOL_SIZE', 32))
+TEMBA_CLIENT_IDLE_TIMEOUT = int(os.environ.get('TEMBA_CLIENT_IDLE_TIMEOUT', 300))
+TEMBA_CLIENT_CONNECTIONS = int(os.environ.get('TEMBA_CLIENT_CONNECTIONS', 4))
+
+# Write each fetched page with a single unordered bulk upsert instead of one query and save per record
+SYNC_BULK_UPSERT = bool(int(os.environ.get('SYNC_BULK_UPSERT', 0)))
+# Refresh records that already exist when Temba has a newer version of them, writing only the changed fields
+SYNC_UPDATE_EXISTING = bool(int(os.environ.get('SYNC_UPDATE_EXISTING', 1)))
+# Number of records converted and written per bulk upsert, bounding the documents held in memory
+SYNC_WRITE_BATCH = int(os.environ.get('SYNC_WRITE_BATCH', 500))
+
+# Maximum number of resolved contacts, flows, groups... kept in memory during a sync
+REFERENCE_CACHE_SIZE = int(os.environ.get('REFERENCE_CACHE_SIZE', 50000))
+
+# Number of uuids requested per call when fetching references missing from a page
+REFERENCE_FETCH_CHUNK = int(os.environ.get('REFERENCE_FETCH_CHUNK', 100))
+
+# Number of pages fetched ahead while the current page is written, 0 fetches and writes pages one after the other
+SYNC_PREFETCH_DEPTH = int(os.environ.get('SYNC_PREFETCH_DEPTH', 2))
+
+# Number of documents rewritten per bulk update when compacting the org stored on existing records
+ORG_MIGRATION_BATCH = int(os.environ.get('ORG_MIGRATION_BATCH', 1000))
+
+# Runs older than RUN_COMPACT_AFTER_DAYS days are compacted by the compact_runs command, RUN_COMPACT_BATCH at a time
+RUN_COMPACT_AFTER_DAYS = int(os.environ.get('RUN_COMPACT_AFTER_DAYS', 90))
+RUN_COMPACT_BATCH = int(os.environ.get('RUN_COMPACT_BATCH', 500))
+
+# How list responses find their count: exact, cached (for COUNT_CACHE_TTL seconds or until the next sync writes),
+# estimated (counting at most COUNT_ESTIMATE_MAX records) or none. Clients can pick one with ?count=
+LIST_COUNT_STRATEGY = os.environ.get('LIST_COUNT_STRATEGY', 'exact')
+COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 10*60))
+COUNT_ESTIMATE_MAX = int(os.environ.get('COUNT_ESTIMATE_MAX', 10000))
+
+# Number of records the import command converts and writes per unordered bulk insert
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 5000))
 
 BROKER_URL = 'redis://'
-
-cron_minutes = int(os.environ.get('FETCH_SLEEP', 60*24*7))
+CELERY_RESULT_BACKEND = 'redis://'
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://')
+
+# Number of (org, entity) syncs allowed to run at the same time, in total and per org. An org can override the
+# latter with its sync_concurrency field
+SYNC_MAX_CONCURRENCY = int(os.environ.get('SYNC_MAX_CONCURRENCY', 8))
+SYNC_ORG_CONCURRENCY = int(os.environ.get('SYNC_ORG_CONCURRENCY', 2))
+# Seconds after which a slot no longer refreshed, e.g. by a dead worker, is reclaimed, and seconds to wait before
+# trying for a slot again
+SYNC_SLOT_TIMEOUT = int(os.environ.get('SYNC_SLOT_TIMEOUT', 6*60*60))
+SYNC_SLOT_RETRY = int(os.environ.get('SYNC_SLOT_RETRY', 60))
+# Only one worker syncs an (org, entity) at a time. Its lease lapses SYNC_LEASE_TTL seconds after it stops renewing
+# it, and any other worker asked to sync the same pair either skips it or waits for it (skip / wait)
+SYNC_LEASE_TTL = int(os.environ.get('SYNC_LEASE_TTL', 10*60))
+SYNC_LEASE_CONFLICT = os.environ.get('SYNC_LEASE_CONFLICT', 'skip')
+
+# Pages that still fail after RETRY_MAX_ATTEMPTS are set aside and the sync moves on to the next page. A sync gives
+# up after SYNC_MAX_PAGE_FAILURES failed pages in a row
+SYNC_MAX_PAGE_FAILURES = int(os.environ.get('SYNC_MAX_PAGE_FAILURES', 3))
+# Set aside pages are retried after FAILED_PAGE_RETRY_WAIT * 2^attempt seconds (at most FAILED_PAGE_RETRY_MAX), and
+# abandoned after FAILED_PAGE_MAX_ATTEMPTS attempts
+FAILED_PAGE_RETRY_WAIT = int(os.environ.get('FAILED_PAGE_RETRY_WAIT', 5*60))
+FAILED_PAGE_RETRY_MAX = int(os.environ.get('FAILED_PAGE_RETRY_MAX', 24*60*60))
+FAILED_PAGE_MAX_ATTEMPTS = int(os.environ.get('FAILED_PAGE_MAX_ATTEMPTS', 8))
+
+# Webhook events are buffered and written in bulk once WEBHOOK_BATCH_SIZE of them are waiting, or
+# WEBHOOK_FLUSH_INTERVAL ms after the first of them arrived
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 200))
+WEBHOOK_FLUSH_INTERVAL = int(os.environ.get('WEBHOOK_FLUSH_INTERVAL', 2000))
+# Seconds before a flush that could not write some events is tried again, and times an event is tried before it is
+# moved to the webhooks:dead list in Redis
+WEBHOOK_RETRY_WAIT = int(os.environ.get('WEBHOOK_RETRY_WAIT', 60))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 5))
+
+# Minutes between incremental syncs of each entity, overridden per org by its sync_cadences field and here by a
+# JSON object in SYNC_CADENCES, e.g. {"Message": 10}. Entities not listed are synced every FETCH_SLEEP minutes
+SYNC_DEFAULT_CADENCE = int(os.environ.get('FETCH_SLEEP', 60*24*7))
+SYNC_CADENCES = dict(Message=5, Run=5, Contact=15, Broadcast=15, Group=60, Label=60, Flow=60*24, Campaign=60*24,
+                     Event=60*24)
+SYNC_CADENCES.update(json.loads(os.environ.get('SYNC_CADENCES', '{}')))
 
 CELERYBEAT_SCHEDULE = {
-    'sync-all': {
-        'task': 'data_api.api.tasks.fetch_all',
-        'schedule': datetime.timedelta(minutes=cron_minutes),
+    'sync-due': {
+        'task': 'data_api.api.tasks.sync_due',
+        'schedule': datetime.timedelta(minutes=1),
+        'args': ()
+    },
+    'retry-failed-pages': {
+        'task': 'data_api.api.tasks.retry_failed_pages',
+        'schedule': datetime.timedelta(minutes=5),
         'args': ()
     }
 }